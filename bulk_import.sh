@@ -13,7 +13,7 @@ do
   end_date=$(date -d "$start_date 1 days" +%Y-%m-%d)
   echo "Running pipeline for $start_date - $end_date" >> $log_file 2>&1
 
-  docker run --name downloader --rm  -v "/home/ubuntu/goes-16:/app" goes_downloader:stable python3 goes-16/main.py -s DATA/ date -d $start_date $end_date >> $log_file 2>&1
+  docker run --name downloader --rm  -v "/home/ubuntu/goes-16:/app" goes_downloader:stable python3 goes-16/main.py -s DATA/ date -g -d $start_date $end_date >> $log_file 2>&1
 
   docker run --name updater --network goes-16_default --rm  -v "/home/ubuntu/goes-16:/app" goes_downloader:stable python3 goes-16/mosaic_update.py >> $log_file 2>&1
 done;
\ No newline at end of file
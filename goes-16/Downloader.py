@@ -1,14 +1,27 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import shutil
 import os
-import time
+import hashlib
 import logging
 
-from osgeo import osr
+import numpy as np
 import s3fs
-import botocore
 
-from bbox import Point, Bbox, Bboxs
+from bbox import Point, Bbox, Bboxs, BboxRegistry
+from fetcher import ConcurrentFetcher, FetchStats
+from listing_index import ListingIndex
+from remote_reader import RemoteGranuleReader
+from granule_cache import GranuleCache
+from manifest import Manifest
+from granule_catalog import GranuleCatalog
+from cloud_index import CloudIndex
+from cloud_series import CloudSeries
+from datacube import DatacubeSink
+from composites import CompositeSink
+from fire_pixels import FirePixelStore
+from pipeline import StreamingPipeline
+from workers import GranuleProcessor, RasterPool
+from projection import projections, file_hash
 
 logging.basicConfig(level=logging.INFO,
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -18,19 +31,71 @@ logging.basicConfig(level=logging.INFO,
 )
 
 class Downloader:
-    def __init__(self, save_dir, read_bbox_datetime:bool=False) -> None:
+    def __init__(self, save_dir, read_bbox_datetime:bool=False, concurrency:int=4, remote_read:bool=False, cache_size_gb:float=20,
+                 workers:int=1, compress:str="DEFLATE", quantize=(), datacube:bool=False,
+                 composite_days:int=0, fire_records:bool=True, shared_tiles:bool=False) -> None:
         self.fs = s3fs.S3FileSystem(anon=True)
         self.root_dir = f"{save_dir}"
         self.boxes = Bboxs.read_file(read_bbox_datetime).boxes
         self.hour_freq = 1
         self.max_retries = 3
         self.tmp_dir = "tmp"
+        self.workspace = os.path.join(self.root_dir, self.tmp_dir) # Set by plan_download()
         self.json_file = "cloud.json"
+        self.OutSR = projections.srs("ESRI:102498")
+        self.state_dir = os.path.join(self.root_dir, "state")
+        self.listing = ListingIndex(self.fs, os.path.join(self.state_dir, "listing.sqlite"))
+        self.manifest = Manifest(os.path.join(self.state_dir, "manifest.sqlite"))
+        self.cloud_index = CloudIndex(os.path.join(self.state_dir, "cloud_index.sqlite"))
+        self.cloud_series = CloudSeries(os.path.join(self.state_dir, "cloud_series.sqlite"))
+        self.cloud_series.import_json(os.path.join(self.root_dir, self.json_file))
+        self.catalog = GranuleCatalog()
+        self.fetcher = ConcurrentFetcher(self.fs,
+                                         prefix_concurrency=concurrency,
+                                         object_concurrency=concurrency,
+                                         max_retries=self.max_retries,
+                                         ls=self.listing.ls)
+        self.remote_read = remote_read
+        self.remote_reader = RemoteGranuleReader(self.fs)
+        self.granule_cache = None
+        if cache_size_gb > 0:
+            self.granule_cache = GranuleCache(self.fs,
+                                              os.path.join(self.state_dir, "granules"),
+                                              int(cache_size_gb * 1024 ** 3),
+                                              info=self.listing.info)
+
+        self.datacube = None
+        if datacube:
+            self.datacube = DatacubeSink(os.path.join(self.root_dir, "cubes"))
+        self.fire_records = fire_records
+        self.fire_pixels = FirePixelStore(os.path.join(self.root_dir, "fires")) if fire_records else None
 
         if read_bbox_datetime:
             self.hour_freq = None # Since we are downloading all available images in an hour
 
+        # Overlapping boxes are gathered once as a shared tile, clustered on their lon/lat rectangles
+        tiles = {}
+        if shared_tiles:
+            tiles = BboxRegistry(self.boxes).tiles(os.path.join(self.state_dir, "tiles"))
+            logging.info(f"{len(tiles)} of {len(self.boxes)} boxes share {len(set(tile.id for tile in tiles.values()))} tiles")
+
         self.__convert_to_WGS__()
+        remap_dir = os.path.join(self.state_dir, "remap")
+        # Outputs are COGs, layers in `quantize` are stored as scaled uint8
+        processor_args = (self.root_dir, remap_dir, self.boxes, compress, tuple(quantize), tiles)
+        self.processor = GranuleProcessor(*processor_args)
+        self.reprojector = self.processor.reprojector
+        # Clear fractions were scored against the cutline, a redrawn box is indexed again
+        changed = self.cloud_index.sync_cutlines({box.id: self.reprojector.__cutline_hash__(box) for box in self.boxes})
+        if changed:
+            logging.info(f"Cleared the cloud index of {len(changed)} new or redrawn boxes")
+        self.pool = None
+        if workers > 1:
+            self.pool = RasterPool(workers, *processor_args)
+        self.composites = None
+        if composite_days > 0:
+            self.composites = CompositeSink(self.root_dir, os.path.join(self.state_dir, "composites"),
+                                            days=composite_days, writer=self.reprojector.writer)
 
         if not os.path.exists(self.root_dir):
             os.mkdir(f"{self.root_dir}")
@@ -39,113 +104,231 @@ class Downloader:
             if not os.path.exists(f"{self.root_dir}/{box.id}"):
                 os.mkdir(f"{self.root_dir}/{box.id}")
 
-    def clean_root_dir(self, param):
-        tmp_dir_path = os.path.join(self.root_dir, self.tmp_dir)
+    def clean_root_dir(self, param=None, directory=None):
+        """Removes tmp/, or only the workspace `directory` inside it"""
+        tmp_dir_path = directory or os.path.join(self.root_dir, self.tmp_dir)
 
         if param == 'ABI-L2-ACMC':
             tmp_dir_path = os.path.join(self.root_dir, 'cloud_mask')
 
         if os.path.exists(tmp_dir_path):
             shutil.rmtree(tmp_dir_path)
+        self.catalog.clear()
+        self.manifest.release(tmp_dir_path)
+        if self.composites is not None:
+            self.composites.flush()
+        self.reprojector.log_stats()
         logging.info(f"Removed tmp directory- {tmp_dir_path}")
 
-    def point_coversion(self, coord: Point):
-        InSR = osr.SpatialReference()
-        InSR.SetFromUserInput("EPSG:4326")
-        OutSR = osr.SpatialReference()
-        OutSR.SetFromUserInput("ESRI:102498")
-
-        transform_epsg = osr.CoordinateTransformation(InSR, OutSR)
-        transformed = transform_epsg.TransformPoint(coord.y, coord.x)
-        return Point(transformed[0], transformed[1])
-
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     def __convert_to_WGS__(self):
+        # Every corner projected in one call, cached under the hash of the files the boxes came from
+        sources = sorted(set(box.path for box in self.boxes))
+        key = hashlib.sha256(repr(["ESRI:102498"] + [file_hash(path) for path in sources]).encode()).hexdigest()
+        cache_path = os.path.join(self.state_dir, "projected_boxes", f"{key[:16]}.npz")
+        ids = np.array([box.id for box in self.boxes], dtype=str)
+
+        xs = ys = None
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as f:
+                if np.array_equal(f["ids"], ids):
+                    xs, ys = f["xs"], f["ys"]
+        if xs is None:
+            xs, ys = projections.transform([[point.x for point in box.box] for box in self.boxes],
+                                           [[point.y for point in box.box] for box in self.boxes],
+                                           "EPSG:4326", "ESRI:102498")
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            part = f"{cache_path}.part.npz"
+            np.savez(part, ids=ids, xs=xs, ys=ys)
+            os.replace(part, cache_path)
+
         boxes = []
-        for box in self.boxes:
-            box_arr = []
-            for point in box.box:
-                p = self.point_coversion(point)
-                box_arr.append(p)
-            boxes.append(Bbox(box_arr, box.id, box.path, box.start, box.end))
+        for box, box_xs, box_ys in zip(self.boxes, xs, ys):
+            box_arr = [Point(float(x), float(y)) for x, y in zip(box_xs, box_ys)]
+            boxes.append(Bbox(box_arr, box.id, box.path, box.start, box.end, box.geometry))
         self.boxes = Bboxs(boxes).boxes
 
-
     def parse_filename(self, filename: str) -> dict:
-        if filename.startswith("OR_"):
-            filename = filename[3:] 
-
-        parts = filename.split('_')
-        if len(parts) != 5:
-            raise ValueError(f"Invalid filename format")
-
-        channel = parts[0][-3:]
-        satellite_id = parts[1]
-        start_time = parts[2][1:]
-        end_time = parts[3][1:]
-        creation_time = parts[4][1:-3]
-
-        start_dt = datetime.strptime(start_time, "%Y%j%H%M%S%f")
-        end_dt = datetime.strptime(end_time, "%Y%j%H%M%S%f")
-        creation_dt = datetime.strptime(creation_time, "%Y%j%H%M%S%f")
-
-        parameters = {
-            "channel": channel,
-            "satellite_id": satellite_id,
-            "start_time": start_dt,
-            "end_time": end_dt,
-            "creation_time": creation_dt,
-        }
-        return parameters
+        return self.catalog.parse(filename).as_dict()
 
     def filename(self, file):
-        par = self.parse_filename(file.replace(".tif", ""))
-        file_path = f"{par['start_time'].year}{str(par['start_time'].month).zfill(2)}{str(par['start_time'].day).zfill(2)}T{str(par['start_time'].hour).zfill(2)}{str(par['start_time'].minute).zfill(2)}{str(par['start_time'].second).zfill(2)}{str(par['start_time'].microsecond).zfill(3)}Z.tif"
-        return file_path
-
-    def download(self, start:datetime, end:datetime, param:str, latest:bool=False):
+        return self.catalog.parse(file).name
+
+    def layer_sources(self, directory, layers):
+        """
+        Yields (file, {save_location: path}) for every granule downloaded to `directory`.
+        NetCDF granules are extracted into /vsimem/ and released once the caller moves on,
+        so only final outputs touch disk. Remote reads already left their layers on disk.
+        """
+        for file in self.processor.layer_files(directory, layers):
+            paths = self.processor.open_layers(directory, file, layers)
+            try:
+                yield file, paths
+            finally:
+                self.processor.close_layers(directory, file, paths)
+
+    def clear_fractions(self, source, boxes=None):
+        return self.processor.clear_fractions(source, boxes)
+
+    def warp_boxes(self, path, boxes, save_location, file_path):
+        return self.processor.warp_boxes(path, boxes, save_location, file_path)
+
+    def sink_outputs(self, file, written):
+        """
+        Feeds the per-box (path, output) pairs `written` from granule `file` to the datacubes
+        and composites, straight from the warped arrays
+        """
+        if not self.keep_outputs:
+            return
+        start_time = self.catalog.parse(file).start_time
+        for path, output in written:
+            layer_dir = os.path.dirname(path)
+            box_id, layer = os.path.basename(os.path.dirname(layer_dir)), os.path.basename(layer_dir)
+            if self.datacube is not None:
+                self.datacube.append(box_id, layer, start_time, **output)
+            if self.composites is not None:
+                self.composites.update(box_id, layer, start_time, **output)
+
+    @property
+    def keep_outputs(self) -> bool:
+        """Whether warp tasks return their arrays, for the datacubes or composites"""
+        return self.datacube is not None or self.composites is not None
+
+    def store_fire_pixels(self, file, records):
+        """Stores the {box id: columns} fire pixels of FDCC granule `file`"""
+        if self.fire_pixels is None or not records:
+            return
+        start_time = self.catalog.parse(file).start_time
+        for box_id, columns in records.items():
+            self.fire_pixels.append(box_id, start_time, columns)
+
+    def index_clouds(self, file, fractions):
+        """Stores {box id: clear fraction} of an ACHAC granule, returning its start time"""
+        start_time = self.catalog.parse(file).start_time
+        self.cloud_index.add(start_time, file.replace('.nc', '.tif'), fractions)
+        return start_time
+
+    def run_tasks(self, method, tasks):
+        """
+        Yields (task, result) of GranuleProcessor.<method>(*task) for every task, on the
+        worker pool when there is one.
+        """
+        if self.pool is not None:
+            yield from self.pool.map(method, tasks)
+            return
+        for task in tasks:
+            yield task, getattr(self.processor, method)(*task)
+
+    def check_tasks(self):
+        """Raises once any pooled task failed, keeping the workspace for a resumed run"""
+        if self.pool is not None and self.pool.errors:
+            errors, self.pool.errors = self.pool.errors, []
+            raise RuntimeError(f"{len(errors)} raster tasks failed, first: {errors[0][1]}: {errors[0][2]}")
+
+    def granule_id(self, file):
+        return self.catalog.parse(file).id
+
+    def download(self, start:datetime, end:datetime, param:str, latest:bool=False, variable:str=None, product:str=None,
+                 skip_hour=None):
+        '''
+        variable: NetCDF variable, or list of (save_location, band) layers, the caller will
+        extract. In remote read mode only these, cropped to the union of all bboxes, are
+        fetched and saved as .tif (layers under <hour dir>/<save_location>/)
+        product: output layer(s) the granules are downloaded for. When given, granules the
+        manifest already has further along are skipped and a leftover workspace is resumed
+        skip_hour: optional skip_hour(hour start) -> bool, hours it accepts are not fetched
+        '''
+        jobs = self.plan_download(start, end, param, latest, product, skip_hour)
+        local_name, getter = self.__getter__(variable, product)
+
+        logging.info(f"Downloading {len(jobs)} hours of {param}")
+        stats = self.fetcher.fetch(jobs, local_name, getter)
+        self.__log_download_stats__()
+        return stats
+
+    def stream_download(self, start:datetime, end:datetime, param:str, stages, latest:bool=False, variable:str=None,
+                        product:str=None, queue_size:int=2, skip_hour=None):
+        '''
+        Same as download() but each hour is handed to `stages` as soon as it has been
+        fetched. Stages are called as stage(day, hour) and run in their own threads with at
+        most `queue_size` hours waiting between them.
+        '''
+        jobs = self.plan_download(start, end, param, latest, product, skip_hour)
+        local_name, getter = self.__getter__(variable, product)
+        stats = FetchStats()
+
+        def fetch_hour(job):
+            self.fetcher.fetch([job], local_name, getter, stats)
+            hour_dir = job[1]
+            return os.path.basename(os.path.dirname(hour_dir)), os.path.basename(hour_dir)
+
+        def chain(stage):
+            def run(item):
+                stage(*item)
+                return item
+            run.__name__ = getattr(stage, "__name__", "stage")
+            return run
+
+        logging.info(f"Streaming {len(jobs)} hours of {param}")
+        StreamingPipeline([fetch_hour] + [chain(stage) for stage in stages], queue_size).run(jobs)
+        logging.info(f"Streamed {stats}")
+        self.__log_download_stats__()
+        return stats
+
+    def plan_download(self, start:datetime, end:datetime, param:str, latest:bool=False, product:str=None, skip_hour=None):
+        '''Lists the hours to fetch and prepares their directories, returning (s3 prefix, directory) jobs'''
 
         logging.info(f"Starting download for date interval: {start} - {end}")
 
-        # Check Year
+        # Check Year, a range may span several
         try:
-            database_year = self.fs.ls(f"s3://noaa-goes16/{param}/")
+            database_year = self.listing.ls(f"s3://noaa-goes16/{param}/")
             file_param_year = [int(x.split("/")[-1]) for x in database_year] 
         except Exception as e:
             raise ValueError(f"Unable to load aws due to {e}")
-        if start.year != end.year:
-            raise ValueError(f"{start.year} and {end.year} should be same")
-        if not start.year in file_param_year:
-            raise ValueError(f"{start.year} not in database")
-        if not end.year in file_param_year:
-            raise ValueError(f"{end.year} not in database")
+        if start.year > end.year:
+            raise ValueError(f"{start} is after {end}")
+        for year in range(start.year, end.year + 1):
+            if not year in file_param_year:
+                raise ValueError(f"{year} not in database")
 
 
-        # Check day
+        # Check day. Days are numbered from Jan 1 of the start year, so they keep counting
+        # past a year boundary and every day of the range has its own directory.
         start_date_in_year = (datetime(start.year, start.month, start.day) - datetime(start.year, 1, 1)).days + 1
         end_date_in_year = (datetime(end.year, end.month, end.day) - datetime(start.year, 1, 1)).days + 1
 
         try:
-            database_day = self.fs.ls(f"s3://noaa-goes16/{param}/{start.year}")
+            database_day = self.listing.ls(f"s3://noaa-goes16/{param}/{end.year}")
             file_param_day = [int(x.split("/")[-1]) for x in database_day]
         except Exception as e:
             raise ValueError(f"Unable to load aws due to {e}")
-        if not end_date_in_year in file_param_day:
+        if not end.timetuple().tm_yday in file_param_day:
             file_param_day.pop(-1)
             start_date_in_year -= 1
             end_date_in_year -= 1
 
-        base_download_dir = os.path.join(self.root_dir, self.tmp_dir)
+        # Every product downloads into its own tmp/<owner>/, so a rerun resumes each stage's leftovers
+        owners = self.__products__(product) or [param]
+        base_download_dir = os.path.join(self.root_dir, self.tmp_dir, "+".join(owners))
         if param == 'ABI-L2-ACMC':
             base_download_dir = os.path.join(self.root_dir, 'cloud_mask')
-        if not os.path.exists(base_download_dir):
-            os.mkdir(base_download_dir)
-
+        self.__claim_workspace__(base_download_dir, owners, product)
+        os.makedirs(base_download_dir, exist_ok=True)
+        self.workspace = base_download_dir
 
+        jobs = []
         for day in range(start_date_in_year, end_date_in_year + 1):
+            date = datetime(start.year, 1, 1) + timedelta(days=day - 1)
+            if not latest and skip_hour is not None and all(skip_hour(date + timedelta(hours=hr)) for hr in range(24)):
+                continue # Not even listed
             try:
-                day_str = '0' * (3 - len(str(day))) + str(day)
-                database_hour = self.fs.ls(f"s3://noaa-goes16/{param}/{start.year}/{day_str}")
+                day_str = str(date.timetuple().tm_yday).zfill(3)
+                database_hour = self.listing.ls(f"s3://noaa-goes16/{param}/{date.year}/{day_str}")
                 file_param_hour = [int(x.split("/")[-1]) for x in database_hour]
             except Exception as e:
                 logging.error(f"Unable to query aws for {day_str}: {param}")
@@ -153,53 +336,107 @@ class Downloader:
 
             if latest:
                 hour = [file_param_hour[-1]]
-            if self.hour_freq is None:
+            elif self.hour_freq is None:
                 hour = file_param_hour # Because we want to download all images available within an hour
             else:
                 hour = file_param_hour[::self.hour_freq]
 
             day_download_dir = os.path.join(base_download_dir, str(day))
-            os.mkdir(day_download_dir)
+            os.makedirs(day_download_dir, exist_ok=True)
 
             # Not downloading for hours that lie before start date hour and that lie after end date hour.
-            if day == start_date_in_year:
-                start_hour = start.hour
+            # The latest hour is never filtered out.
+            if not latest and day == start_date_in_year:
                 hour = list(filter(lambda e: e > start.hour, hour))
-            elif day == end_date_in_year:
-                end_hour = end.hour
+            elif not latest and day == end_date_in_year:
                 hour = list(filter(lambda e: e < end.hour, hour))
 
+            if skip_hour is not None:
+                hour = [hr for hr in hour if not skip_hour(date + timedelta(hours=hr))]
+
             for hr in hour:
                 hour_download_dir = os.path.join(day_download_dir, str(hr))
-                os.mkdir(hour_download_dir)
-                files = self.fs.ls(f"s3://noaa-goes16/{param}/{start.year}/{day_str}/{str(hr).zfill(2)}/")
-                logging.info(f"Downloading files for {day}:{hr}")
-
-                retries = 0
-                while retries < self.max_retries:
-
-                    try:
-                        logging.debug(f"Downloading files- {files}\n{hour_download_dir}")
-                        self.fs.get(files, f"{hour_download_dir}/")
-                        logging.info(f"Files have been downloaded")
-                        break
-                    except botocore.exceptions.ClientError as e:
-                        if e.response['Error']['Code'] == 'Throttling':
-                            backoff_time = (2 ** retries) * 120 # 120 seconds as base time
-                            logging.warning(f"Throttling detected. Retrying in {backoff_time} seconds.")
-                            time.sleep(backoff_time)
-                            retries += 1
-                        else:
-                            # For other errors, raise the exception
-                            logging.error(f"Unable to Download aws data for {day}: {param}")
-                            raise e
-                else:
-                    raise Exception(f"Failed to download file after {max_retries} retries.")
-                
-                for file in os.listdir(hour_download_dir):
-                    source = os.path.join(hour_download_dir, file)
-                    dst = os.path.join(hour_download_dir, self.filename(file).replace('.tif', '.nc'))
-                    os.rename(source, dst)
-    
-                break
-            break
\ No newline at end of file
+                os.makedirs(hour_download_dir, exist_ok=True)
+                jobs.append((f"s3://noaa-goes16/{param}/{date.year}/{day_str}/{str(hr).zfill(2)}/", hour_download_dir))
+
+        return jobs
+
+    @staticmethod
+    def __products__(product):
+        if product is None:
+            return []
+        return [product] if isinstance(product, str) else list(product)
+
+    @staticmethod
+    def layer_paths(path, layers):
+        """GeoTIFF path of every (save_location, band) layer extracted from the granule at `path`"""
+        file_name = os.path.basename(path).replace('.nc', '.tif')
+        return {save_location: os.path.join(os.path.dirname(path), save_location, file_name) for save_location, _ in layers}
+
+    def __getter__(self, variable, product):
+        local_name = os.path.basename
+        if self.remote_read and variable is not None:
+            bounds = self.remote_reader.bounds(self.boxes)
+            local_name = lambda file: file.replace('.nc', '.tif')
+            if isinstance(variable, str):
+                getter = lambda key, path: self.remote_reader.read_window(key, variable, bounds, path)
+            else:
+                getter = lambda key, path: self.remote_reader.read_layers(key, variable, self.layer_paths(path, variable), bounds)
+        elif self.granule_cache is not None:
+            getter = self.granule_cache.get
+        else:
+            getter = self.fs.get
+
+        if product is not None:
+            getter = self.__resumable__(getter, product)
+        return local_name, self.__cataloged__(getter, variable)
+
+    def __cataloged__(self, getter, variable):
+        # Granules present once the getter returns are recorded with their workspace hour
+        def get(key, local_path):
+            getter(key, local_path)
+            paths = [local_path]
+            if self.remote_read and variable is not None and not isinstance(variable, str):
+                paths += self.layer_paths(local_path, variable).values()
+            if any(os.path.exists(path) for path in paths):
+                hour_dir = os.path.dirname(local_path)
+                self.catalog.add(local_path, os.path.basename(os.path.dirname(hour_dir)), os.path.basename(hour_dir))
+        return get
+
+    def __log_download_stats__(self):
+        if self.granule_cache is not None:
+            self.granule_cache.log_stats()
+        self.listing.log_stats()
+
+    def __claim_workspace__(self, directory, owners, product):
+        # A workspace left behind by the same products is resumed, anything else starts clean
+        owner = ",".join(owners)
+        previous_owner = self.manifest.claim(directory, owner)
+        if previous_owner == owner and os.path.exists(directory):
+            logging.info(f"Resuming {owner} in {directory}")
+            return
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+            self.catalog.clear()
+        for p in self.__products__(product):
+            self.manifest.reset_incomplete(p)
+
+    def __resumable__(self, getter, product):
+        products = self.__products__(product)
+
+        def get(key, local_path):
+            hour_dir = os.path.dirname(local_path)
+            day, hr = os.path.basename(os.path.dirname(hour_dir)), os.path.basename(hour_dir)
+            granule = self.granule_id(os.path.basename(key))
+
+            states = [self.manifest.state(p, granule) for p in products]
+            if all(state in ("warped", "ingested") for state in states):
+                return
+            if all(state is not None for state in states) and os.path.exists(local_path):
+                return
+
+            getter(key, local_path)
+            for p in products:
+                self.manifest.mark(p, day, hr, granule, "downloaded")
+        return get
@@ -2,6 +2,16 @@ import json
 from typing import List
 import os
 import datetime
+from bisect import bisect_right
+
+import hashlib
+
+import numpy as np
+import shapely
+from shapely import STRtree
+
+# Single indexed collection of every box, see bbox_generator_1
+COLLECTION = "boxes.geojson"
 
 
 class Point:
@@ -17,40 +27,190 @@ class Point:
         return cls(lis[0], lis[1])
 
 class Bbox:
-    def __init__(self, box:List[Point], id:str, path, start_date:datetime=None, end_date:datetime=None) -> None:
+    def __init__(self, box:List[Point], id:str, path, start_date:datetime=None, end_date:datetime=None, geometry:dict=None) -> None:
         self.box = box
         self.id = id
         self.path = path
         self.start = start_date
         self.end = end_date
+        self.geometry = geometry # GeoJSON geometry of boxes read from a collection, their path is shared
 
     def __str__(self) -> str:
         return f"{self.id}: p1: {self.box[0]}\n p2: {self.box[1]}\n p3: {self.box[2]}\n p4: {self.box[3]}\nStart & End date time: {self.start} - {self.end}"
 
+class BboxIndex:
+    """Bounds of every box as arrays, so all boxes are tested against an extent at once"""
+    def __init__(self, boxes: List[Bbox]) -> None:
+        self.boxes = boxes
+        xs = np.array([[point.x for point in box.box] for box in boxes], dtype=np.float64).reshape(len(boxes), -1)
+        ys = np.array([[point.y for point in box.box] for box in boxes], dtype=np.float64).reshape(len(boxes), -1)
+        self.minx, self.maxx = xs.min(axis=1, initial=np.inf), xs.max(axis=1, initial=-np.inf)
+        self.miny, self.maxy = ys.min(axis=1, initial=np.inf), ys.max(axis=1, initial=-np.inf)
+
+    def query(self, minx, miny, maxx, maxy) -> List[Bbox]:
+        hits = (self.minx <= maxx) & (self.maxx >= minx) & (self.miny <= maxy) & (self.maxy >= miny)
+        return [self.boxes[i] for i in np.flatnonzero(hits)]
+
+class BoxSchedule:
+    """
+    Interval index of the boxes' (start, end) windows. Overlapping windows are merged so
+    stretches without any active box are rejected with one bisect, and the boxes active
+    at a time are found among the windows sorted by start.
+    """
+    def __init__(self, boxes: List[Bbox]) -> None:
+        self.intervals = sorted(((box.start, box.end, box) for box in boxes if box.start is not None and box.end is not None),
+                                key=lambda interval: interval[:2])
+        self.starts = [start for start, _, _ in self.intervals]
+
+        self.windows = []
+        for start, end, _ in self.intervals:
+            if self.windows and start <= self.windows[-1][1]:
+                self.windows[-1][1] = max(self.windows[-1][1], end)
+            else:
+                self.windows.append([start, end])
+        self.start = self.windows[0][0] if self.windows else None
+        self.end = self.windows[-1][1] if self.windows else None
+
+    def covers(self, start:datetime.datetime, end:datetime.datetime=None) -> bool:
+        """Whether any box is active between start and end"""
+        i = bisect_right(self.windows, [end or start, datetime.datetime.max])
+        return i > 0 and self.windows[i - 1][1] >= start
+
+    def active(self, start:datetime.datetime, end:datetime.datetime=None) -> List[Bbox]:
+        """Boxes whose window overlaps start..end (the single time start without end)"""
+        if not self.covers(start, end):
+            return []
+        return [box for _, box_end, box in self.intervals[:bisect_right(self.starts, end or start)] if box_end >= start]
+
+class Tile(Bbox):
+    """A processing tile covering several overlapping boxes, `members` are their ids"""
+    def __init__(self, box:List[Point], id:str, path, members:List[str]) -> None:
+        super().__init__(box, id, path)
+        self.members = members
+
+class BboxRegistry:
+    """
+    STRtree over the boxes' lon/lat rectangles. Finds overlapping boxes and clusters them
+    into shared tiles: two clusters are merged when their common envelope is no larger than
+    the two processed apart, so a tile never costs more pixels than its members.
+    """
+    def __init__(self, boxes: List[Bbox]) -> None:
+        self.boxes = boxes
+        xs = np.array([[point.x for point in box.box] for box in boxes], dtype=np.float64).reshape(len(boxes), -1)
+        ys = np.array([[point.y for point in box.box] for box in boxes], dtype=np.float64).reshape(len(boxes), -1)
+        self.bounds = np.column_stack([xs.min(axis=1, initial=np.inf), ys.min(axis=1, initial=np.inf),
+                                       xs.max(axis=1, initial=-np.inf), ys.max(axis=1, initial=-np.inf)])
+        self.geometries = shapely.box(*self.bounds.T)
+        self.tree = STRtree(self.geometries)
+
+    def overlapping(self, box: Bbox) -> List[Bbox]:
+        """Other boxes intersecting box"""
+        i = self.boxes.index(box)
+        return [self.boxes[j] for j in self.tree.query(self.geometries[i], predicate="intersects") if j != i]
+
+    def pairs(self):
+        """(i, j, overlap area) of every pair of intersecting boxes, i < j"""
+        i, j = self.tree.query(self.geometries, predicate="intersects")
+        keep = i < j
+        i, j = i[keep], j[keep]
+        return i, j, shapely.area(shapely.intersection(self.geometries[i], self.geometries[j]))
+
+    def clusters(self) -> List[List[Bbox]]:
+        parent = np.arange(len(self.boxes))
+        envelope = self.bounds.copy()
+        cost = shapely.area(self.geometries)
+        area = lambda b: (b[2] - b[0]) * (b[3] - b[1])
+
+        def find(k):
+            while parent[k] != k:
+                parent[k] = parent[parent[k]]
+                k = parent[k]
+            return k
+
+        # Most overlapping pairs first
+        i, j, overlap = self.pairs()
+        for k in np.argsort(-overlap, kind="stable"):
+            a, b = find(i[k]), find(j[k])
+            if a == b:
+                continue
+            merged = np.concatenate([np.minimum(envelope[a, :2], envelope[b, :2]), np.maximum(envelope[a, 2:], envelope[b, 2:])])
+            if area(merged) <= cost[a] + cost[b]:
+                parent[b] = a
+                envelope[a] = merged
+                cost[a] += cost[b]
+
+        clusters = {}
+        for k, box in enumerate(self.boxes):
+            clusters.setdefault(find(k), []).append(box)
+        return list(clusters.values())
+
+    def tiles(self, tile_dir) -> dict:
+        """
+        {box id: Tile} for the boxes sharing a tile, each tile written to
+        <tile_dir>/<tile id>.json as its cutline. Boxes alone in their cluster are left out.
+        """
+        tiles = {}
+        for members in self.clusters():
+            if len(members) < 2:
+                continue
+            ids = sorted(box.id for box in members)
+            minx, miny, maxx, maxy = self.bounds[[self.boxes.index(box) for box in members]].T
+            minx, miny, maxx, maxy = minx.min(), miny.min(), maxx.max(), maxy.max()
+            tile_id = "tile_" + hashlib.sha1(",".join(ids).encode()).hexdigest()[:12]
+            path = os.path.join(tile_dir, f"{tile_id}.json")
+            os.makedirs(tile_dir, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump({"type": "FeatureCollection",
+                           "features": [{"type": "Feature",
+                                         "properties": {"members": ids},
+                                         "geometry": {"type": "Polygon",
+                                                      "coordinates": [[[minx, maxy], [minx, miny], [maxx, miny],
+                                                                       [maxx, maxy], [minx, maxy]]]}}]}, f)
+            tile = Tile([Point(minx, maxy), Point(minx, miny), Point(maxx, miny), Point(maxx, maxy)], tile_id, path, ids)
+            tiles.update({box_id: tile for box_id in ids})
+        return tiles
+
 class Bboxs:
     def __init__(self, boxes: List[Bbox]) -> None:
         self.boxes = boxes
         
-    @classmethod
-    def read_file(cls, read_datetime:bool=False):
+    @staticmethod
+    def __box__(feature, id, path, read_datetime:bool=False, geometry:dict=None) -> Bbox:
+        points = []
+        coord = feature["geometry"]["coordinates"][0][:4]
+        for p in coord:
+            points.append(Point.from_list(p))
+
+        start_date = None
+        end_date = None
+        if read_datetime:
+            start_date = datetime.datetime.strptime(feature['properties']['start_date'], '%Y-%m-%dT%H:%M:%SZ')
+            end_date = datetime.datetime.strptime(feature['properties']['end_date'], '%Y-%m-%dT%H:%M:%SZ')
+        return Bbox(points, id, path, start_date, end_date, geometry)
 
+    @classmethod
+    def read_file(cls, read_datetime:bool=False, directory:str="./geojson/"):
+        """
+        Boxes of the collection written by bbox_generator_1 (one read), then of any
+        single-box files in directory the collection does not already hold
+        """
         boxes = []
-        for file in os.listdir("./geojson/"):
-            with open(f"./geojson/{file}", 'r') as f:
+        collection = os.path.join(directory, COLLECTION)
+        if os.path.exists(collection):
+            with open(collection, 'r') as f:
+                data = json.load(f)
+            for feature in data["features"]:
+                boxes.append(cls.__box__(feature, str(feature["id"]), collection, read_datetime, feature["geometry"]))
+
+        collected = set(box.id for box in boxes)
+        for file in sorted(os.listdir(directory)):
+            if file == COLLECTION or file.endswith(".part") or file.replace(".json", "") in collected:
+                continue
+            with open(os.path.join(directory, file), 'r') as f:
                 data = json.load(f)
 
             for b_box in data["features"]:
-                points = []
-                coord = b_box["geometry"]["coordinates"][0][:4]
-                for p in coord:
-                    points.append(Point.from_list(p))
-
-                start_date = None
-                end_date = None
-                if read_datetime:
-                    start_date = datetime.datetime.strptime(b_box['properties']['start_date'], '%Y-%m-%dT%H:%M:%SZ')
-                    end_date = datetime.datetime.strptime(b_box['properties']['end_date'], '%Y-%m-%dT%H:%M:%SZ')
-                boxes.append(Bbox(points, file.replace(".json", ""), f"./geojson/{file}", start_date, end_date))
+                boxes.append(cls.__box__(b_box, file.replace(".json", ""), os.path.join(directory, file), read_datetime))
         return cls(boxes)
 
 
@@ -1,96 +1,132 @@
 import os
 import argparse
+import logging
+import itertools
+from datetime import datetime, date, timezone
 import shapely
 import fiona
 import json
 import numpy as np
-from pyproj import Proj,transform
-from geojson import Polygon, Feature, load
-from shapely.geometry import shape
 
-def generate_bounding_box_geojson(center_point, startDate, endDate, fireArea, box_size_acres=80062.1):
+from bbox import COLLECTION
+
+# NIFC perimeter attributes: full names in GeoJSON exports, truncated in shapefiles.
+# The first one set is used.
+FIELDS = {
+    "id": ("poly_SourceOID", "poly_Sourc"),
+    "acres": ("poly_GISAcres", "poly_GISAc"),
+    "start": ("poly_PolygonDateTime", "poly_CreateDate", "attr_Fir_7"),
+    "end": ("attr_ContainmentDateTime", "attr_ModifiedOnDateTime_dt", "attr_Conta"),
+}
+
+def bounding_boxes(center_latitude, center_longitude, box_size_acres=80062.1):
     '''
+    (min_lon, min_lat, max_lon, max_lat) arrays of the boxes centred on every point.
     box_size_acres: Desired area of bbox. Default as 324 sq km, in acres.
     '''
     box_size_km = box_size_acres*0.00404686
-    center_latitude, center_longitude = center_point
-
-    min_latitude = center_latitude - (box_size_km / 2) / 111.111
-    max_latitude = center_latitude + (box_size_km / 2) / 111.111
-    min_longitude = center_longitude - (box_size_km / 2) / (111.321 * abs(np.cos(np.radians(center_latitude))))
-    max_longitude = center_longitude + (box_size_km / 2) / (111.321 * abs(np.cos(np.radians(center_latitude))))
-
-    # Create GeoJSON Polygon
-    polygon_coordinates = [
-        (min_longitude, max_latitude),
-        (min_longitude, min_latitude),
-        (max_longitude, min_latitude),
-        (max_longitude, max_latitude),
-        (min_longitude, max_latitude)
-    ]
-    polygon=Polygon()
-    polygon['coordinates']=[polygon_coordinates]
-    feature = Feature(geometry=polygon)
-    feature.properties['start_date'] = startDate
-    feature.properties['end_date'] = endDate
-    feature.properties['area'] = fireArea
-
-    finalJson ={
-        "type":"FeatureCollection",
-        "features":[feature]
-    }
-    return finalJson
-
-
-def dumpjson(root:os, bounding_box_geojson, filename:str):
-    json_dump_dir = os.path.join(os.path.dirname(root), 'geojson')
-    filename+=".json"
-    with open(os.path.join(json_dump_dir,filename),'w') as json_file:
-        json.dump(bounding_box_geojson, json_file,indent=2)
-
-
-#reading 
-def geojsonFile(file:str):
-    try:
-        if file.endswith(".json") == False:
-            return
-        with open(file) as geojson_file:
-            
-            geojson_dict = load(geojson_file)
-            features = geojson_dict['features']
-
-            for feature in features:
-
-                geometry = feature['geometry']
-                properties = feature['properties']
-                shapely_geometry = shape(geometry)
-
-                sourceOID = properties["poly_SourceOID"]
-                area_acres = properties['poly_GISAcres']
-                fireDisoveryDateTime = properties['poly_PolygonDateTime'] if properties['poly_PolygonDateTime'] is not None else properties['poly_CreateDate']
-                fireControlDateTime = properties['attr_ContainmentDateTime'] if properties['attr_ContainmentDateTime'] is not None else properties['attr_ModifiedOnDateTime_dt']
-                #fireControlDateTime = properties['attr_ContainmentDateTime'] if properties['attr_ContainmentDateTime'] is not None else None
-
-                if area_acres < 10.0 or (fireDisoveryDateTime is None or fireControlDateTime is None):
-                    print(sourceOID, area_acres, fireDisoveryDateTime, fireControlDateTime)
-                    continue
-
-                bounding_box = shapely_geometry.bounds
-                bounding_box_geojson = generate_bounding_box_geojson(( (bounding_box[1]+bounding_box[3])/2, (bounding_box[0]+bounding_box[2])/2 ), fireDisoveryDateTime, fireControlDateTime, area_acres)
-                root = os.path.dirname(os.path.abspath(__file__))
-                dumpjson(root, bounding_box_geojson,str(sourceOID))
-    except Exception as e:
-        print("Exception Occurred")
-        raise
+    half_lat = (box_size_km / 2) / 111.111
+    half_lon = (box_size_km / 2) / (111.321 * np.abs(np.cos(np.radians(center_latitude))))
+    return center_longitude - half_lon, center_latitude - half_lat, center_longitude + half_lon, center_latitude + half_lat
+
+
+def timestamp(value):
+    """NIFC date (ISO string, datetime or epoch milliseconds) as the '%Y-%m-%dT%H:%M:%SZ' bbox dates"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        value = datetime.fromtimestamp(value / 1000, timezone.utc)
+    elif isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    elif isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def field(properties, name):
+    for key in FIELDS[name]:
+        if properties.get(key) is not None:
+            return properties[key]
+    return None
+
+
+def ingest(file:str, out_path:str, min_acres:float=10.0, box_size_acres:float=80062.1, batch_size:int=10000):
+    """
+    Streams the perimeters of `file` (GeoJSON, shapefile or anything fiona reads) in
+    batches and writes one box per fire to the collection at out_path. Bounds and boxes
+    are computed for a whole batch at once. A fire's later perimeters replace earlier ones.
+    """
+    boxes = {}
+    skipped = 0
+    with fiona.open(file) as collection:
+        features = iter(collection)
+        while True:
+            batch = list(itertools.islice(features, batch_size))
+            if not batch:
+                break
+            properties = [dict(feature.properties) for feature in batch]
+            ids = [field(p, "id") for p in properties]
+            acres = np.array([field(p, "acres") or 0.0 for p in properties], dtype=np.float64)
+            starts = [timestamp(field(p, "start")) for p in properties]
+            ends = [timestamp(field(p, "end")) for p in properties]
+
+            # The whole batch is parsed by one shapely call, missing geometries stay None
+            geometries = np.array([None if feature.geometry is None else
+                                   json.dumps(getattr(feature.geometry, "__geo_interface__", feature.geometry))
+                                   for feature in batch], dtype=object)
+            bounds = shapely.bounds(shapely.from_geojson(geometries))
+            keep = ((acres >= min_acres) & np.all(np.isfinite(bounds), axis=1)
+                    & np.array([i is not None and s is not None and e is not None for i, s, e in zip(ids, starts, ends)]))
+            skipped += int(np.count_nonzero(~keep))
+
+            minx, miny, maxx, maxy = bounds[keep].T
+            box_bounds = np.column_stack(bounding_boxes((miny + maxy) / 2, (minx + maxx) / 2, box_size_acres))
+            for k, b in zip(np.flatnonzero(keep), box_bounds):
+                boxes[str(ids[k])] = (b.tolist(), starts[k], ends[k], float(acres[k]))
+    logging.info(f"{len(boxes)} boxes from {file}, {skipped} perimeters skipped")
+    write_collection(boxes, out_path)
+    return boxes
+
+
+def write_collection(boxes, out_path:str):
+    """Writes {id: (bounds, start, end, area)} as one FeatureCollection, features carrying their bbox"""
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    part = f"{out_path}.part"
+    with open(part, 'w') as json_file:
+        json_file.write('{"type": "FeatureCollection", "features": [\n')
+        for i, (box_id, ((min_longitude, min_latitude, max_longitude, max_latitude), start, end, area)) in enumerate(sorted(boxes.items())):
+            feature = {
+                "type": "Feature",
+                "id": box_id,
+                "bbox": [min_longitude, min_latitude, max_longitude, max_latitude],
+                "geometry": {"type": "Polygon", "coordinates": [[
+                    [min_longitude, max_latitude],
+                    [min_longitude, min_latitude],
+                    [max_longitude, min_latitude],
+                    [max_longitude, max_latitude],
+                    [min_longitude, max_latitude]]]},
+                "properties": {"start_date": start, "end_date": end, "area": area},
+            }
+            json_file.write(("," if i else "") + json.dumps(feature) + "\n")
+        json_file.write("]}\n")
+    os.replace(part, out_path)
 
 def main() -> None:
     parser = argparse.ArgumentParser()
-    parser.add_argument("-f", "--file", required=True)
+    parser.add_argument("-f", "-g", "--file", "--geojson-file", dest="file", required=True)
+    parser.add_argument("-o", "--output", default=None,
+                        help=f"Box collection to write, geojson/{COLLECTION} next to goes-16 by default")
+    parser.add_argument("--min-acres", type=float, default=10.0)
+    parser.add_argument("--batch-size", type=int, default=10000)
 
     args = parser.parse_args()
-    file_path = args.file
+    logging.basicConfig(level=logging.INFO)
+    root = os.path.dirname(os.path.abspath(__file__))
+    out_path = args.output or os.path.join(os.path.dirname(root), 'geojson', COLLECTION)
 
-    geojsonFile(file_path)
+    ingest(args.file, out_path, args.min_acres, batch_size=args.batch_size)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,42 +1,122 @@
 import os
-from random import randint
 import datetime
 import csv
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from osgeo import gdal
 
+from store import SQLiteStore
+
 data_dir = '/app/geoserver/datadir/mosaic_dir'
 regions = ['happy_camp', 'bigwood', 'carson', 'oakland']
 band = 'wld_map'
 csv_header = ['region', 'date', 'confidence']
 
-def __tif_validity(f_path, band):
-    ds = gdal.Open(f_path)
-    raster_array = np.array(ds.GetRasterBand(1).ReadAsArray())
 
+class FireScores(SQLiteStore):
+    """
+    Mean fire confidence of every scanned mosaic granule, keyed by path and remembered
+    with the file's mtime so a granule is scored once. confidence is NULL without fire.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS fire_scores (
+            path TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            region TEXT NOT NULL,
+            date TEXT NOT NULL,
+            confidence REAL
+        );
+        CREATE INDEX IF NOT EXISTS fire_scores_region_date ON fire_scores (region, date);
+    """
+
+    def scanned(self, region):
+        return dict(self.execute("SELECT path, mtime FROM fire_scores WHERE region=?", (region,)))
+
+    def add(self, rows):
+        self.executemany("INSERT OR REPLACE INTO fire_scores VALUES (?, ?, ?, ?, ?)", rows)
+
+    def forget(self, paths):
+        self.executemany("DELETE FROM fire_scores WHERE path=?", [(path,) for path in paths])
+
+    def fires(self, region, start:str=None, end:str=None):
+        return self.execute("""
+            SELECT region, date, confidence FROM fire_scores
+            WHERE region=? AND confidence IS NOT NULL AND date >= ? AND date <= ?
+            ORDER BY date
+        """, (region, start or "", end or "9999"))
+
+
+def __ingestion(f_path, band):
     file_name = os.path.basename(f_path)
     granuel_prefix = band.replace('_', '') + '_'
     ingestion_timestamp = file_name.replace(granuel_prefix, '').replace('_', '').replace('T', '').replace('Z', '').replace('.tif', '')
-    ingestion = datetime.datetime.strptime(ingestion_timestamp, '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+    return datetime.datetime.strptime(ingestion_timestamp, '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
 
-    fire_found_raster = raster_array[raster_array > 0]
-    if fire_found_raster.size:
-        return ingestion, np.mean(fire_found_raster)
-    return None
+def __tif_validity(f_path, band):
+    ds = gdal.Open(f_path)
+    raster_band = ds.GetRasterBand(1)
+    ingestion = __ingestion(f_path, band)
+
+    # Outputs carry their statistics, a tile without any positive pixel is rejected unread
+    valid_percent = raster_band.GetMetadataItem("STATISTICS_VALID_PERCENT")
+    maximum = raster_band.GetMetadataItem("STATISTICS_MAXIMUM")
+    if valid_percent is not None and (float(valid_percent) == 0 or (maximum is not None and float(maximum) <= 0)):
+        return ingestion, None
 
-csv_file = f"{__file__}.csv".replace('.py', '')
-with open(csv_file, 'w') as f:
-    writer = csv.writer(f)
-    writer.writerow(csv_header)
+    # Otherwise one block window at a time, skipping blocks GDAL knows to be empty
+    total, count = 0.0, 0
+    block_cols, block_rows = raster_band.GetBlockSize()
+    for row in range(0, ds.RasterYSize, block_rows):
+        for col in range(0, ds.RasterXSize, block_cols):
+            cols, rows = min(block_cols, ds.RasterXSize - col), min(block_rows, ds.RasterYSize - row)
+            status, _ = raster_band.GetDataCoverageStatus(col, row, cols, rows)
+            if status & gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY and not status & gdal.GDAL_DATA_COVERAGE_STATUS_DATA:
+                continue
+            block = raster_band.ReadAsArray(col, row, cols, rows)
+            fire_found_raster = block[block > 0]
+            total += float(fire_found_raster.sum(dtype=np.float64))
+            count += fire_found_raster.size
+    ds = None
 
+    if count:
+        # Quantized confidence is stored as scaled uint8 codes
+        return ingestion, total / count * (raster_band.GetScale() or 1.0) + (raster_band.GetOffset() or 0.0)
+    return ingestion, None
+
+def scan(store:FireScores, workers:int=8):
+    """Scores the granules added or rewritten since the last scan, in parallel"""
     for region in regions:
         region_dir = os.path.join(data_dir, region + '_' + band)
-        tif_files = [os.path.join(region_dir, file) for file in os.listdir(region_dir) if file.find('.tif') > -1]
-        fire_data = []
-        for tif_file in tif_files:
-            data = __tif_validity(tif_file, band)
-            if data is not None:
-                fire_data.append([region, data[0], data[1]])
-        fire_data = sorted(fire_data, key = lambda x: str(x[1]))
-        writer.writerows(fire_data)
\ No newline at end of file
+        tif_files = {os.path.join(region_dir, file): os.path.getmtime(os.path.join(region_dir, file))
+                     for file in os.listdir(region_dir) if file.find('.tif') > -1}
+        scanned = store.scanned(region)
+        store.forget(set(scanned) - set(tif_files))
+        pending = [path for path, mtime in tif_files.items() if scanned.get(path) != mtime]
+        logging.info(f"{region}: {len(pending)} of {len(tif_files)} granules to score")
+
+        with ThreadPoolExecutor(workers) as executor:
+            results = executor.map(lambda path: __tif_validity(path, band), pending)
+            store.add([(path, tif_files[path], region, ingestion, confidence)
+                       for path, (ingestion, confidence) in zip(pending, results)])
+
+def export_csv(store:FireScores, csv_file):
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(csv_header)
+        for region in regions:
+            writer.writerows(store.fires(region))
+
+
+if __name__ == "__main__":
+    csv_file = f"{__file__}.csv".replace('.py', '')
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument("--db", default=f"{__file__}.sqlite".replace('.py', ''))
+    args = parser.parse_args()
+
+    store = FireScores(args.db)
+    scan(store, args.workers)
+    export_csv(store, csv_file)
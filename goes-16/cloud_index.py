@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+from store import SQLiteStore
+
+
+def hour_key(start_time:datetime) -> str:
+    return start_time.strftime("%Y-%m-%dT%H")
+
+
+class CloudIndex(SQLiteStore):
+    """
+    Clear-sky fraction of every box in every scored ACHAC granule, kept across runs.
+    Hours are recorded once all their granules were scored for a box, so a backfill over
+    an already indexed period never downloads ACHAC again.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS cloud_cover (
+            box_id TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            hour TEXT NOT NULL,
+            fraction REAL NOT NULL,
+            file TEXT NOT NULL,
+            PRIMARY KEY (box_id, start_time)
+        );
+        CREATE INDEX IF NOT EXISTS cloud_cover_hour ON cloud_cover (box_id, hour, fraction);
+        CREATE TABLE IF NOT EXISTS indexed_hours (
+            box_id TEXT NOT NULL,
+            hour TEXT NOT NULL,
+            PRIMARY KEY (box_id, hour)
+        );
+        CREATE TABLE IF NOT EXISTS box_cutlines (
+            box_id TEXT PRIMARY KEY,
+            cutline TEXT NOT NULL
+        );
+    """
+
+    def sync_cutlines(self, cutlines):
+        """
+        cutlines: box id -> hash of its cutline. Drops the fractions and indexed hours of every
+        box whose cutline changed, or was never recorded, and returns their ids.
+        """
+        known = dict(self.execute("SELECT box_id, cutline FROM box_cutlines"))
+        changed = [(box_id,) for box_id, cutline in cutlines.items() if known.get(box_id) != cutline]
+        self.executemany("DELETE FROM cloud_cover WHERE box_id = ?", changed)
+        self.executemany("DELETE FROM indexed_hours WHERE box_id = ?", changed)
+        self.executemany("INSERT OR REPLACE INTO box_cutlines VALUES (?, ?)", cutlines.items())
+        return [box_id for box_id, in changed]
+
+    def add(self, start_time:datetime, file, fractions):
+        """fractions: box id -> clear fraction of the granule starting at start_time"""
+        self.executemany("INSERT OR REPLACE INTO cloud_cover VALUES (?, ?, ?, ?, ?)",
+                         [(box_id, start_time.isoformat(), hour_key(start_time), float(fraction), file)
+                          for box_id, fraction in fractions.items()])
+
+    def mark_indexed(self, box_ids, hours):
+        self.executemany("INSERT OR IGNORE INTO indexed_hours VALUES (?, ?)",
+                         [(box_id, hour) for box_id in box_ids for hour in hours])
+
+    def indexed_hours(self, box_ids):
+        """Hours indexed for every box in box_ids"""
+        box_ids = list(box_ids)
+        if not box_ids:
+            return set()
+        rows = self.execute(f"""
+            SELECT hour FROM indexed_hours WHERE box_id IN ({",".join("?" * len(box_ids))})
+            GROUP BY hour HAVING COUNT(DISTINCT box_id) = ?
+        """, box_ids + [len(box_ids)])
+        return {hour for hour, in rows}
+
+    def clearest(self, start:datetime, end:datetime):
+        """
+        Clearest granule of every box and hour in [start, end], as
+        {box id: {hour: (fraction, start_time, file)}}
+        """
+        rows = self.execute("""
+            SELECT box_id, hour, fraction, start_time, file FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY box_id, hour ORDER BY fraction DESC, start_time) AS rank
+                FROM cloud_cover WHERE hour >= ? AND hour <= ?
+            ) WHERE rank = 1
+        """, (hour_key(start), hour_key(end)))
+        clearest = {}
+        for box_id, hour, fraction, start_time, file in rows:
+            clearest.setdefault(box_id, {})[hour] = (fraction, datetime.fromisoformat(start_time), file)
+        return clearest
+
+    @staticmethod
+    def closed(hour:str, now:datetime=None) -> bool:
+        """Whether all granules of hour have landed, with an hour of slack for late arrivals"""
+        return datetime.strptime(hour, "%Y-%m-%dT%H") + timedelta(hours=2) <= (now or datetime.utcnow())
@@ -0,0 +1,61 @@
+import os
+import json
+import logging
+from itertools import groupby
+
+from store import SQLiteStore
+
+
+class CloudSeries(SQLiteStore):
+    """
+    Append-only time series of the per-box cloud values published in cloud.json, keyed by
+    timestamp and box id. export_json() writes the {timestamp: {box id: value}} shape.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS cloud_values (
+            timestamp TEXT NOT NULL,
+            box_id TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (timestamp, box_id)
+        );
+        CREATE INDEX IF NOT EXISTS cloud_values_box ON cloud_values (box_id, timestamp);
+    """
+
+    def append(self, timestamp:str, values):
+        """values: box id -> cloud value at timestamp"""
+        self.executemany("INSERT OR REPLACE INTO cloud_values VALUES (?, ?, ?)",
+                         [(timestamp, box_id, value) for box_id, value in values.items()])
+
+    def range(self, start:str=None, end:str=None, box_ids=None):
+        """Yields (timestamp, {box id: value}) in time order, for start <= timestamp <= end"""
+        sql, params = "SELECT timestamp, box_id, value FROM cloud_values WHERE 1=1", []
+        if start is not None:
+            sql, params = sql + " AND timestamp >= ?", params + [start]
+        if end is not None:
+            sql, params = sql + " AND timestamp <= ?", params + [end]
+        if box_ids is not None:
+            box_ids = list(box_ids)
+            sql, params = sql + f" AND box_id IN ({','.join('?' * len(box_ids))})", params + box_ids
+        rows = self.execute(sql + " ORDER BY timestamp, rowid", params)
+        for timestamp, group in groupby(rows, key=lambda row: row[0]):
+            yield timestamp, {box_id: value for _, box_id, value in group}
+
+    def import_json(self, path):
+        """Loads an existing cloud.json, once, into an empty store"""
+        if not os.path.exists(path) or self.execute("SELECT 1 FROM cloud_values LIMIT 1"):
+            return
+        with open(path, "r") as f:
+            data = json.load(f)
+        for timestamp, values in data.items():
+            self.append(timestamp, values)
+        logging.info(f"Imported {len(data)} timestamps from {path}")
+
+    def export_json(self, path, start:str=None, end:str=None):
+        """Writes the series in the cloud.json shape to a temporary file renamed over `path`"""
+        part = f"{path}.part"
+        with open(part, "w") as f:
+            f.write("{")
+            for i, (timestamp, values) in enumerate(self.range(start, end)):
+                f.write(f"{', ' if i else ''}{json.dumps(timestamp)}: {json.dumps(values)}")
+            f.write("}")
+        os.replace(part, path)
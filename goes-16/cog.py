@@ -0,0 +1,77 @@
+import numpy as np
+from osgeo import gdal, gdal_array
+
+
+class CogWriter:
+    """
+    Writes outputs as Cloud-Optimized GeoTIFFs: internal tiles, DEFLATE/ZSTD compression with
+    a predictor and overviews. Layers named in `quantize` (e.g. the wildfire confidence, which
+    holds a handful of values in [0, 1]) are stored as uint8 with a 0.01 band scale.
+    """
+    quantize_step = 0.01
+
+    def __init__(self, compress:str="DEFLATE", blocksize:int=256, overviews:bool=True, quantize=()) -> None:
+        self.compress = compress.upper()
+        self.blocksize = blocksize
+        self.overviews = overviews
+        self.quantize = tuple(quantize)
+
+    def options(self):
+        options = [f"BLOCKSIZE={self.blocksize}",
+                   f"COMPRESS={self.compress}",
+                   f"OVERVIEWS={'AUTO' if self.overviews else 'NONE'}",
+                   "RESAMPLING=NEAREST"]
+        if self.compress != "NONE":
+            options.append("PREDICTOR=YES")
+        return options
+
+    def quantized(self, data, nodata=None, scale=None, offset=None):
+        """uint8 codes of data in steps of quantize_step, nodata moved to 255 when it is not a code"""
+        codes = np.clip(np.rint(data / self.quantize_step), 0, 254).astype(np.uint8)
+        if nodata is not None:
+            code = nodata / self.quantize_step
+            code = int(round(code)) if 0 <= code <= 254 else 255
+            codes[data == nodata] = code
+            nodata = code
+        return codes, nodata, (scale or 1.0) * self.quantize_step, offset
+
+    def write(self, path, data, geo_transform, projection, nodata=None, scale=None, offset=None, layer=None):
+        if layer in self.quantize:
+            data, nodata, scale, offset = self.quantized(data, nodata, scale, offset)
+
+        mem_ds = gdal.GetDriverByName("MEM").Create("", data.shape[1], data.shape[0], 1,
+                                                    gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype))
+        mem_ds.SetGeoTransform(geo_transform)
+        mem_ds.SetProjection(projection)
+        band = mem_ds.GetRasterBand(1)
+        band.WriteArray(data)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        if scale is not None:
+            band.SetScale(scale)
+        if offset is not None:
+            band.SetOffset(offset)
+        self.set_statistics(band, data, nodata)
+        gdal.GetDriverByName("COG").CreateCopy(path, mem_ds, options=self.options())
+        mem_ds = None
+        return path
+
+    @staticmethod
+    def set_statistics(band, data, nodata=None):
+        """Stores the band statistics so readers can tell empty tiles without reading pixels"""
+        valid = data[data != nodata] if nodata is not None else data.ravel()
+        if valid.size:
+            band.SetStatistics(float(valid.min()), float(valid.max()), float(valid.mean()), float(valid.std()))
+        band.SetMetadataItem("STATISTICS_VALID_PERCENT", str(100.0 * valid.size / max(data.size, 1)))
+
+    def translate(self, src, dst):
+        """Copies an existing GeoTIFF to dst as a COG"""
+        gdal.Translate(dst, src, options=gdal.TranslateOptions(format="COG", creationOptions=self.options()))
+        return dst
+
+    @staticmethod
+    def is_cog(path):
+        ds = gdal.Open(path)
+        layout = ds.GetMetadataItem("LAYOUT", "IMAGE_STRUCTURE")
+        ds = None
+        return layout == "COG"
@@ -0,0 +1,121 @@
+import os
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from cog import CogWriter
+
+EPOCH = datetime(1970, 1, 1)
+
+# Statistics kept per layer: max and mean of the physical values, count of clear
+# observations (scans where the layer has no data, e.g. no cloud top) and the time
+# of the first scan with a value above 0
+DEFAULT_COMPOSITES = {
+    "wld_map": ("max", "mean", "first"),
+    "cloud": ("clear",),
+}
+
+
+class CompositeSink:
+    """
+    Running temporal composites of per-box outputs over periods of `days` days, updated
+    from each granule's arrays as it is warped. Aggregates live in memory and in
+    <state_dir>/<box>/<layer>_<period>.npz; flush() writes them as mosaic-ready COGs under
+    <root_dir>/<box>/<layer>_<stat>/<period start>.tif.
+    """
+    def __init__(self, root_dir, state_dir, composites=None, days:int=1, writer:CogWriter=None) -> None:
+        self.root_dir = root_dir
+        self.state_dir = state_dir
+        self.composites = composites or DEFAULT_COMPOSITES
+        self.days = days
+        self.writer = writer or CogWriter()
+        self.states = {}
+        self.dirty = set()
+
+    def period(self, start_time:datetime) -> datetime:
+        days = (start_time.replace(tzinfo=None) - EPOCH).days
+        return EPOCH + timedelta(days=days - days % self.days)
+
+    def __state_path__(self, box_id, layer, period):
+        return os.path.join(self.state_dir, box_id, f"{layer}_{period:%Y%m%d}.npz")
+
+    def __state__(self, key, shape, geo_transform, projection):
+        if key not in self.states:
+            path = self.__state_path__(*key)
+            if os.path.exists(path):
+                with np.load(path) as f:
+                    self.states[key] = {name: f[name] for name in f.files}
+                self.states[key]["projection"] = str(self.states[key]["projection"])
+        state = self.states.get(key)
+        if state is None or state["max"].shape != shape:
+            if state is not None:
+                logging.warning(f"Grid of {key} changed, restarting its composite")
+            state = self.states[key] = {
+                "max": np.full(shape, -np.inf, dtype=np.float32),
+                "sum": np.zeros(shape, dtype=np.float64),
+                "valid": np.zeros(shape, dtype=np.uint16),
+                "first": np.full(shape, np.inf, dtype=np.float64),
+                "scans": np.zeros(0, dtype=np.float64),
+                "geo_transform": np.asarray(geo_transform, dtype=np.float64),
+                "projection": projection,
+            }
+        return state
+
+    def update(self, box_id, layer, start_time:datetime, data, geo_transform, projection, nodata=None,
+               scale=None, offset=None):
+        if layer not in self.composites:
+            return
+        key = (box_id, layer, self.period(start_time))
+        state = self.__state__(key, data.shape, geo_transform, projection)
+        seconds = (start_time.replace(tzinfo=None) - EPOCH).total_seconds()
+        if seconds in state["scans"]:
+            return # Already aggregated, e.g. by an interrupted run
+
+        valid = np.ones(data.shape, dtype=bool) if nodata is None else data != nodata
+        values = data.astype(np.float64) * (scale or 1.0) + (offset or 0.0)
+        valid &= np.isfinite(values)
+        values = np.where(valid, values, 0)
+
+        np.maximum(state["max"], np.where(valid, values, -np.inf).astype(np.float32), out=state["max"])
+        state["sum"] += values
+        state["valid"] += valid
+        state["first"] = np.where(valid & (values > 0), np.minimum(state["first"], seconds), state["first"])
+        state["scans"] = np.append(state["scans"], seconds)
+        self.dirty.add(key)
+
+    def flush(self):
+        for key in sorted(self.dirty):
+            box_id, layer, period = key
+            state = self.states[key]
+            path = self.__state_path__(*key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part = f"{path}.part.npz"
+            np.savez(part, **state)
+            os.replace(part, path)
+
+            for stat in self.composites[layer]:
+                self.__write__(box_id, layer, period, stat, state)
+        if self.dirty:
+            logging.info(f"Updated {len(self.dirty)} composites")
+        self.dirty.clear()
+
+    def __write__(self, box_id, layer, period, stat, state):
+        observed = state["valid"] > 0
+        if stat == "max":
+            data, nodata = np.where(observed, state["max"], -9999).astype(np.float32), -9999
+        elif stat == "mean":
+            mean = state["sum"] / np.maximum(state["valid"], 1)
+            data, nodata = np.where(observed, mean, -9999).astype(np.float32), -9999
+        elif stat == "clear":
+            data, nodata = (len(state["scans"]) - state["valid"]).astype(np.uint16), None
+        elif stat == "first":
+            first = np.where(np.isfinite(state["first"]), state["first"], 0)
+            data, nodata = first.astype(np.uint32), 0
+        else:
+            raise ValueError(f"Unknown composite statistic {stat}")
+
+        out_dir = os.path.join(self.root_dir, box_id, f"{layer}_{stat}")
+        os.makedirs(out_dir, exist_ok=True)
+        self.writer.write(os.path.join(out_dir, f"{period:%Y%m%dT%H%M%S}000Z.tif"), data,
+                          tuple(state["geo_transform"]), state["projection"], nodata)
@@ -1,39 +1,75 @@
-from osgeo import gdal
+from functools import lru_cache
+
 import numpy as np
-from osgeo.gdalconst import GDT_Float32
-
-def wildfire_area(in_file, save_loc, default_confidence_value=0):
-    conf_map = {10: 1.0,
-                30: 1.0,
-                11: 0.9,
-                31: 0.9,
-                12: 0.8,
-                32: 0.8,
-                13: 0.5,
-                33: 0.5,
-                14: 0.3,
-                34: 0.3,
-                15: 0.1,
-                35: 0.1,
-                }
-
-    inDs = gdal.Open(f"NETCDF:{in_file}:{'Mask'}")
-    band1 = inDs.GetRasterBand(1)
-    rows = inDs.RasterYSize
-    cols = inDs.RasterXSize
-    cropData = band1.ReadAsArray(0,0,cols,rows)
-    file_name = in_file.split("/")[-1].replace("FDCC", "WLD")
-
-    driver = inDs.GetDriver()
-    outDs = driver.Create(f"{save_loc}/{file_name}", cols, rows, 1, GDT_Float32)
-    outBand = outDs.GetRasterBand(1)
-    outData = np.ones(cropData.shape, dtype=np.float32) * default_confidence_value
-    for v, conf in conf_map.items():
-        outData[cropData == v] = conf
-
-    outBand.WriteArray(outData)
-    outBand.FlushCache()
-    outBand.SetNoDataValue(default_confidence_value)
-    outDs.SetGeoTransform(inDs.GetGeoTransform())
-    outDs.SetProjection(inDs.GetProjection())
-    del outData
+
+conf_map = {10: 1.0,
+            30: 1.0,
+            11: 0.9,
+            31: 0.9,
+            12: 0.8,
+            32: 0.8,
+            13: 0.5,
+            33: 0.5,
+            14: 0.3,
+            34: 0.3,
+            15: 0.1,
+            35: 0.1,
+            }
+
+@lru_cache(maxsize=None)
+def lookup_table(mapping, default_value=0, dtype=np.float32):
+    """256-entry table for np.take, `mapping` is a tuple of (code, value) pairs"""
+    table = np.full(256, default_value, dtype=dtype)
+    for code, value in mapping:
+        table[code] = value
+    return table
+
+def wildfire_confidence(mask, default_confidence_value=0):
+    # Fill values (< 0) clip to code 0, which is not a fire code
+    return np.take(lookup_table(tuple(conf_map.items()), default_confidence_value), mask, mode="clip")
+
+def threshold(minimum=None, maximum=None):
+    """Keeps physical values within [minimum, maximum], everything else becomes nodata"""
+    def layer(values, nodata=0):
+        keep = np.isfinite(values)
+        if minimum is not None:
+            keep &= values >= minimum
+        if maximum is not None:
+            keep &= values <= maximum
+        return np.where(keep, values, nodata).astype(np.float32)
+    return layer
+
+
+class DerivedLayer:
+    """
+    A layer computed block by block from one NetCDF variable. function(values, nodata)
+    gets the stored values, or physical values (scale/offset applied, fill as NaN) when
+    `scaled` is set.
+    """
+    def __init__(self, source:str, function, nodata=0, dtype=np.float32, scaled:bool=False) -> None:
+        self.source = source
+        self.function = function
+        self.nodata = nodata
+        self.dtype = np.dtype(dtype)
+        self.scaled = scaled
+
+    def compute(self, block):
+        values = block["data"]
+        if self.scaled:
+            values = values.astype(np.float64)
+            if block["nodata"] is not None:
+                values[block["data"] == block["nodata"]] = np.nan
+            values = values * (block["scale"] or 1.0) + (block["offset"] or 0.0)
+        return self.function(values, self.nodata).astype(self.dtype, copy=False)
+
+
+# Layers derived from a NetCDF variable, by name
+DERIVED_LAYERS = {}
+
+def register_layer(name, layer:DerivedLayer):
+    DERIVED_LAYERS[name] = layer
+
+register_layer("wildfire", DerivedLayer("Mask", wildfire_confidence, 0))
+register_layer("fire_area", DerivedLayer("Area", threshold(minimum=0), 0, scaled=True))
+register_layer("fire_power", DerivedLayer("Power", threshold(minimum=0), 0, scaled=True))
+register_layer("fire_temp", DerivedLayer("Temp", threshold(minimum=0), 0, scaled=True))
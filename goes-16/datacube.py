@@ -0,0 +1,78 @@
+import os
+import logging
+from datetime import datetime
+
+import numpy as np
+import h5netcdf
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class DatacubeSink:
+    """
+    Appends every per-box output to a NetCDF datacube per box and layer,
+    <cube_dir>/<box>/<layer>.nc, with dimensions (time, y, x). Chunks span `time_chunk`
+    scans and `space_chunk` pixels square, so both single maps and per-pixel time series
+    are a few chunk reads. Times are kept sorted, so a scan finishing after a later one
+    is inserted at its place; a rerun overwrites its scan.
+    """
+    def __init__(self, cube_dir, time_chunk:int=24, space_chunk:int=64) -> None:
+        self.cube_dir = cube_dir
+        self.time_chunk = time_chunk
+        self.space_chunk = space_chunk
+
+    def path(self, box_id, layer):
+        return os.path.join(self.cube_dir, box_id, f"{layer}.nc")
+
+    def append(self, box_id, layer, start_time:datetime, data, geo_transform, projection, nodata=None,
+               scale=None, offset=None):
+        path = self.path(box_id, layer)
+        if not os.path.exists(path):
+            self.__create__(path, layer, data, geo_transform, projection, nodata, scale, offset)
+
+        seconds = (start_time.replace(tzinfo=None) - EPOCH).total_seconds()
+        with h5netcdf.File(path, "a") as nc:
+            var = nc.variables[layer]
+            if var.shape[1:] != data.shape:
+                logging.warning(f"{path} holds {var.shape[1:]} maps, skipping a {data.shape} map of {start_time}")
+                return
+            times = nc.variables["time"][:]
+            index = int(np.searchsorted(times, seconds))
+            if index == len(times) or times[index] != seconds:
+                nc.resize_dimension("time", len(times) + 1)
+                # Later scans move up by one, a time chunk at a time from the end
+                for stop in range(len(times), index, -self.time_chunk):
+                    start = max(stop - self.time_chunk, index)
+                    var[start + 1:stop + 1] = var[start:stop]
+                    nc.variables["time"][start + 1:stop + 1] = times[start:stop]
+                nc.variables["time"][index] = seconds
+            var[index, :, :] = data.astype(var.dtype, copy=False)
+
+    def __create__(self, path, layer, data, geo_transform, projection, nodata, scale, offset):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rows, cols = data.shape
+        with h5netcdf.File(path, "w") as nc:
+            nc.dimensions = {"time": None, "y": rows, "x": cols}
+
+            time = nc.create_variable("time", ("time",), np.float64, chunks=(max(self.time_chunk, 1),))
+            time.attrs["units"] = "seconds since 1970-01-01 00:00:00"
+            time.attrs["standard_name"] = "time"
+            x = nc.create_variable("x", ("x",), np.float64)
+            x[:] = geo_transform[0] + (np.arange(cols) + 0.5) * geo_transform[1]
+            y = nc.create_variable("y", ("y",), np.float64)
+            y[:] = geo_transform[3] + (np.arange(rows) + 0.5) * geo_transform[5]
+
+            crs = nc.create_variable("spatial_ref", (), np.int32)
+            crs.attrs["crs_wkt"] = projection
+            crs.attrs["spatial_ref"] = projection
+            crs.attrs["GeoTransform"] = " ".join(str(v) for v in geo_transform)
+
+            chunks = (self.time_chunk, min(rows, self.space_chunk), min(cols, self.space_chunk))
+            var = nc.create_variable(layer, ("time", "y", "x"), data.dtype, chunks=chunks,
+                                     compression="gzip", shuffle=True,
+                                     fillvalue=None if nodata is None else data.dtype.type(nodata))
+            var.attrs["grid_mapping"] = "spatial_ref"
+            if scale is not None:
+                var.attrs["scale_factor"] = scale
+            if offset is not None:
+                var.attrs["add_offset"] = offset
@@ -0,0 +1,154 @@
+import os
+
+import numpy as np
+import h5netcdf
+from osgeo import gdal, gdal_array
+
+from custom_layers import DERIVED_LAYERS
+from projection import projections
+
+
+class GranuleExtractor:
+    """
+    Extracts any number of variables and derived layers (see custom_layers.DERIVED_LAYERS)
+    from an open GOES NetCDF granule in one pass. Every block of a source variable is read
+    once for all layers and each layer is written as a GeoTIFF in the ABI fixed grid (ESRI:102498), the same as
+    gdal.Translate of NETCDF:<file>:<band>.
+    """
+    def __init__(self, padding:int=2, block_rows:int=None) -> None:
+        self.padding = padding
+        self.block_rows_override = block_rows
+
+        self.projection = projections.wkt("ESRI:102498")
+
+    @staticmethod
+    def values(variable, data=None):
+        if data is None:
+            data = variable[...]
+        data = np.asarray(data)
+        unsigned = str(variable.attrs.get("_Unsigned", "false")).lower() == "true"
+        if unsigned and data.dtype.kind == "i":
+            data = data.view(data.dtype.str.replace("i", "u"))
+        return data
+
+    @classmethod
+    def dtype(cls, variable):
+        return cls.values(variable, np.zeros(0, variable.dtype)).dtype
+
+    @staticmethod
+    def coordinate(variable):
+        values = variable[...].astype(np.float64)
+        return values * variable.attrs.get("scale_factor", 1.0) + variable.attrs.get("add_offset", 0.0)
+
+    def grid(self, nc):
+        height = nc.variables["goes_imager_projection"].attrs["perspective_point_height"]
+        return self.coordinate(nc.variables["x"]) * height, self.coordinate(nc.variables["y"]) * height
+
+    def window(self, x, y, bounds):
+        """Row/column slices of the pixels covering bounds, padded and clipped to the grid"""
+        if bounds is None:
+            return slice(0, len(y)), slice(0, len(x))
+
+        minx, miny, maxx, maxy = bounds
+        dx, dy = x[1] - x[0], y[1] - y[0]
+        left, top = x[0] - dx / 2, y[0] - dy / 2
+
+        col0 = int(np.floor((minx - left) / dx)) - self.padding
+        col1 = int(np.floor((maxx - left) / dx)) + 1 + self.padding
+        row0 = int(np.floor((maxy - top) / dy)) - self.padding
+        row1 = int(np.floor((miny - top) / dy)) + 1 + self.padding
+
+        col0, col1 = max(col0, 0), min(col1, len(x))
+        row0, row1 = max(row0, 0), min(row1, len(y))
+        if col0 >= col1 or row0 >= row1:
+            return None
+        return slice(row0, row1), slice(col0, col1)
+
+    def __source__(self, nc, name):
+        var = nc.variables[name]
+        fill_value = var.attrs.get("_FillValue")
+        if fill_value is not None:
+            fill_value = float(self.values(var, np.atleast_1d(fill_value))[0])
+        scale = var.attrs.get("scale_factor")
+        offset = var.attrs.get("add_offset")
+        return {"variable": var,
+                "nodata": fill_value,
+                "scale": None if scale is None else float(np.atleast_1d(scale)[0]),
+                "offset": None if offset is None else float(np.atleast_1d(offset)[0])}
+
+    def block_rows(self, sources):
+        """Rows read at a time: the tallest NetCDF chunk of the sources, or block_rows when set"""
+        if self.block_rows_override is not None:
+            return self.block_rows_override
+        heights = [source["variable"].chunks[0] for source in sources.values() if source["variable"].chunks]
+        return max(heights) if heights else 256
+
+    def extract(self, nc, layers, out_paths, bounds=None):
+        """
+        layers: list of (name, band) where band is a NetCDF variable or a derived layer.
+        out_paths: name -> GeoTIFF path. bounds: optional ESRI:102498 window to read.
+        Returns out_paths, or None when the granule does not cover bounds.
+        Sources are read and layers written block by block, so every block is read once
+        for all layers. The layers themselves are full rasters, read whole by Reprojector.read.
+        """
+        x, y = self.grid(nc)
+        window = self.window(x, y, bounds)
+        if window is None:
+            return None
+        rows, cols = window
+
+        sources = {}
+        for _, band in layers:
+            source = DERIVED_LAYERS[band].source if band in DERIVED_LAYERS else band
+            if source not in sources:
+                sources[source] = self.__source__(nc, source)
+
+        dx, dy = x[1] - x[0], y[1] - y[0]
+        geo_transform = (x[cols.start] - dx / 2, dx, 0.0, y[rows.start] - dy / 2, 0.0, dy)
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+        outputs = {}
+        for name, band in layers:
+            if band in DERIVED_LAYERS:
+                layer = DERIVED_LAYERS[band]
+                meta = {"dtype": layer.dtype, "nodata": layer.nodata, "scale": None, "offset": None}
+            else:
+                meta = dict(sources[band], dtype=self.dtype(sources[band]["variable"]))
+            outputs[name] = self.create(out_paths[name], shape, meta, geo_transform)
+
+        block_rows = self.block_rows(sources)
+        for row in range(rows.start, rows.stop, block_rows):
+            block = slice(row, min(row + block_rows, rows.stop))
+            blocks = {name: dict(source, data=self.values(source["variable"], source["variable"][block, cols]))
+                      for name, source in sources.items()}
+            for name, band in layers:
+                if band in DERIVED_LAYERS:
+                    data = DERIVED_LAYERS[band].compute(blocks[DERIVED_LAYERS[band].source])
+                else:
+                    data = blocks[band]["data"]
+                outputs[name].GetRasterBand(1).WriteArray(data, 0, row - rows.start)
+
+        for name in outputs:
+            outputs[name].GetRasterBand(1).FlushCache()
+            outputs[name] = None
+        return out_paths
+
+    def extract_file(self, path, layers, out_paths, bounds=None):
+        with h5netcdf.File(path, "r") as nc:
+            return self.extract(nc, layers, out_paths, bounds)
+
+    def create(self, path, shape, meta, geo_transform):
+        if not path.startswith("/vsimem/"):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        driver = gdal.GetDriverByName("GTiff")
+        out_ds = driver.Create(path, shape[1], shape[0], 1,
+                               gdal_array.NumericTypeCodeToGDALTypeCode(meta["dtype"]))
+        out_ds.SetGeoTransform(geo_transform)
+        out_ds.SetProjection(self.projection)
+        band = out_ds.GetRasterBand(1)
+        if meta["nodata"] is not None:
+            band.SetNoDataValue(meta["nodata"])
+        if meta["scale"] is not None:
+            band.SetScale(meta["scale"])
+        if meta["offset"] is not None:
+            band.SetOffset(meta["offset"])
+        return out_ds
@@ -0,0 +1,108 @@
+import os
+import time
+import threading
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import botocore
+
+# Dropped connections and timeouts, as raised by s3fs, aiohttp and botocore
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, asyncio.TimeoutError,
+                    aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+
+
+class FetchStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.objects = 0
+        self.bytes = 0
+        self.retries = 0
+        self.started = time.monotonic()
+
+    def add(self, size:int):
+        with self.lock:
+            self.objects += 1
+            self.bytes += size
+
+    def retried(self):
+        with self.lock:
+            self.retries += 1
+
+    @property
+    def elapsed(self) -> float:
+        return max(time.monotonic() - self.started, 1e-6)
+
+    @property
+    def throughput(self) -> float:
+        """Aggregate throughput in MB/s since the stats were created"""
+        return self.bytes / (1024 * 1024) / self.elapsed
+
+    def __str__(self) -> str:
+        return f"{self.objects} objects, {self.bytes / (1024 * 1024):.1f} MB in {self.elapsed:.1f}s " \
+               f"({self.throughput:.2f} MB/s, {self.retries} retries)"
+
+
+class ConcurrentFetcher:
+    """
+    Fetches S3 objects with a bounded number of hour-prefixes in flight and a
+    bounded number of objects in flight inside each prefix.
+    """
+    def __init__(self, fs, prefix_concurrency:int=4, object_concurrency:int=4, max_retries:int=3, backoff_base:int=120, ls=None) -> None:
+        self.fs = fs
+        self.ls = ls or fs.ls
+        self.prefix_concurrency = prefix_concurrency
+        self.object_concurrency = object_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+
+    def fetch(self, jobs, local_name=os.path.basename, getter=None, stats:FetchStats=None):
+        """
+        jobs: list of (s3 prefix, local directory) pairs.
+        local_name: maps an object's basename to its local file name.
+        getter: called as getter(key, local_path) to materialise an object, fs.get by default.
+        stats: accumulates into existing stats, e.g. across the hours of a stream.
+        """
+        stats = stats or FetchStats()
+        with ThreadPoolExecutor(max_workers=self.prefix_concurrency) as pool:
+            futures = [pool.submit(self.__fetch_prefix__, prefix, local_dir, local_name, getter, stats) for prefix, local_dir in jobs]
+            for future in futures:
+                future.result()
+        logging.info(f"Fetched {stats}")
+        return stats
+
+    def __fetch_prefix__(self, prefix, local_dir, local_name, getter, stats):
+        keys = self.ls(prefix)
+        logging.info(f"Downloading {len(keys)} files from {prefix}")
+        with ThreadPoolExecutor(max_workers=self.object_concurrency) as pool:
+            futures = [pool.submit(self.fetch_object, key, os.path.join(local_dir, local_name(os.path.basename(key))), stats, getter)
+                       for key in keys]
+            for future in futures:
+                future.result()
+
+    def fetch_object(self, key, local_path, stats:FetchStats, getter=None):
+        getter = getter or self.fs.get
+        retries = 0
+        while True:
+            try:
+                getter(key, local_path)
+                if os.path.exists(local_path):
+                    stats.add(os.path.getsize(local_path))
+                return local_path
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('Throttling', 'SlowDown'):
+                    logging.error(f"Unable to Download aws data for {key}")
+                    raise
+                error = e
+            except TRANSIENT_ERRORS as e:
+                error = e
+
+            if retries >= self.max_retries:
+                raise Exception(f"Failed to download {key} after {self.max_retries} retries.") from error
+            backoff_time = (2 ** retries) * self.backoff_base
+            logging.warning(f"{error!r} while downloading {key}. Retrying in {backoff_time} seconds.")
+            stats.retried()
+            time.sleep(backoff_time)
+            retries += 1
@@ -0,0 +1,89 @@
+import os
+import csv
+from datetime import datetime
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1)
+EARTH_RADIUS = 6378137.0
+
+# Column order of every partition and export
+COLUMNS = ("time", "x", "y", "lon", "lat", "confidence", "power", "temp", "area")
+
+
+def mercator_to_lonlat(x, y):
+    """EPSG:3857 metres to WGS84 degrees"""
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+class FirePixelStore:
+    """
+    Fire pixels of every granule as columns (see COLUMNS), partitioned by box and UTC day
+    under <store_dir>/<box>/<YYYYmmdd>.npz and sorted by time within a partition. A
+    granule's pixels take a few kilobytes and queries only open the partitions they need.
+    """
+    def __init__(self, store_dir) -> None:
+        self.store_dir = store_dir
+
+    def __partition__(self, box_id, day:datetime):
+        return os.path.join(self.store_dir, box_id, f"{day:%Y%m%d}.npz")
+
+    @staticmethod
+    def __load__(path):
+        if not os.path.exists(path):
+            return {column: np.zeros(0, dtype=np.float64) for column in COLUMNS}
+        with np.load(path) as f:
+            return {column: f[column] for column in COLUMNS}
+
+    def append(self, box_id, start_time:datetime, columns):
+        """columns: x, y, confidence, power, temp and area arrays of one granule's fire pixels in box_id"""
+        start_time = start_time.replace(tzinfo=None)
+        seconds = (start_time - EPOCH).total_seconds()
+        path = self.__partition__(box_id, start_time)
+        partition = self.__load__(path)
+
+        # A reprocessed granule replaces its earlier pixels
+        keep = partition["time"] != seconds
+        lon, lat = mercator_to_lonlat(np.asarray(columns["x"]), np.asarray(columns["y"]))
+        granule = dict(columns, time=np.full(len(lon), seconds), lon=lon, lat=lat)
+        merged = {column: np.concatenate([partition[column][keep], np.asarray(granule[column], dtype=np.float64)])
+                  for column in COLUMNS}
+        order = np.argsort(merged["time"], kind="stable")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = f"{path}.part.npz"
+        np.savez_compressed(part, **{column: values[order] for column, values in merged.items()})
+        os.replace(part, path)
+
+    def query(self, box_ids=None, start:datetime=None, end:datetime=None):
+        """Yields (box_id, columns) of the fire pixels with start <= time <= end"""
+        if not os.path.isdir(self.store_dir):
+            return
+        start_day = None if start is None else f"{start:%Y%m%d}"
+        end_day = None if end is None else f"{end:%Y%m%d}"
+        for box_id in sorted(box_ids or os.listdir(self.store_dir)):
+            box_dir = os.path.join(self.store_dir, box_id)
+            if not os.path.isdir(box_dir):
+                continue
+            for file in sorted(os.listdir(box_dir)):
+                if not file.endswith(".npz") or file.endswith(".part.npz"):
+                    continue
+                day = file.replace(".npz", "")
+                if (start_day and day < start_day) or (end_day and day > end_day):
+                    continue
+                columns = self.__load__(os.path.join(box_dir, file))
+                times = columns["time"]
+                lo = 0 if start is None else np.searchsorted(times, (start - EPOCH).total_seconds(), "left")
+                hi = len(times) if end is None else np.searchsorted(times, (end - EPOCH).total_seconds(), "right")
+                if hi > lo:
+                    yield box_id, {column: values[lo:hi] for column, values in columns.items()}
+
+    def export_csv(self, csv_file, box_ids=None, start:datetime=None, end:datetime=None):
+        with open(csv_file, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(("box",) + COLUMNS)
+            for box_id, columns in self.query(box_ids, start, end):
+                times = [datetime.utcfromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') for t in columns["time"]]
+                writer.writerows(zip([box_id] * len(times), times, *(columns[column] for column in COLUMNS[1:])))
@@ -1,15 +1,13 @@
-from datetime import datetime
-from operator import itemgetter
+from datetime import datetime, timedelta
 
-from osgeo import gdal
 import os
-from PIL import Image
-import numpy as np
 import shutil
-from custom_layers import wildfire_area
-from osgeo import osr
 import logging
 from Downloader import Downloader
+from bbox import BoxSchedule
+from cloud_index import CloudIndex, hour_key
+
+HOUR = timedelta(hours=1)
 
 logging.basicConfig(level=logging.INFO,
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -20,254 +18,157 @@ logging.basicConfig(level=logging.INFO,
 
 
 class GoesDownloaderDate(Downloader):
-    def __init__(self, save_dir, start:datetime=None, end:datetime=None) -> None:
-        super().__init__(save_dir)
+    def __init__(self, save_dir, start:datetime=None, end:datetime=None, stream:bool=False, **kwargs) -> None:
+        super().__init__(save_dir, **kwargs)
         self.start = start
         self.end = end
+        self.stream = stream # Process each hour as soon as it is downloaded
 
         logging.info("Calculating cloud cover for Bulk Download")
         self.__bbox_cloud_covers__()
-        self.__index_bbox__()
-
-    def wildfire_map(self):
-        self.download(self.start, self.end, "ABI-L2-FDCC")
-        for box in self.boxes:
-            if not os.path.exists(f"{self.root_dir}/{box.id}/wld_map"):
-                os.mkdir(f"{self.root_dir}/{box.id}/wld_map/")
-
-        for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}/"):
-            for hr in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                for file in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"):
-                    directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"
-                    wildfire_area(f"{directory}/{file}", directory)
-                    os.remove(f"{directory}/{file}")
-
-        for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}/"):
-            for hr in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                for file in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"):
-                    directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"
-                    layer = gdal.Open(f"{directory}/{file}")
-                    options = gdal.TranslateOptions(format="GTiff")
-                    file_name = file.replace('.nc', '.tif')
-                    gdal.Translate(f"{directory}/{file_name}", layer, options=options)
-                    os.remove(f"{directory}/{file}")
-
-        OutSR = osr.SpatialReference()
-        OutSR.SetFromUserInput("ESRI:102498")
-
-        for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}/"):
-            for hr in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                for file in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"):
-                    directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"
-                    file_path = self.filename(file)
-                    for (box, box_path) in self.box_file_map.items():
-                        min_box_file = self.parse_filename(box_path[day][hr].replace(".tif", ""))["start_time"]
-                        if self.parse_filename(file.replace(".tif", ""))["start_time"] != min_box_file:
-                            continue
 
-                        options = gdal.WarpOptions(format="GTiff",
-                                                   srcSRS=OutSR,
-                                                   dstSRS='EPSG:3857',
-                                                   cutlineDSName=f"{box.path}",
-                                                   cropToCutline=True)
+    def __hours__(self):
+        return self.catalog.hours()
+
+    def __process__(self, param, variable, product, stages, skip_hour=None):
+        """
+        Downloads `param` and runs every stage(hours) over the downloaded (day, hr) hours,
+        either stage by stage over the whole range or streamed hour by hour.
+        """
+        def skip(hour_start):
+            if not self.__active_boxes__(hour_start, hour_start + HOUR):
+                return True
+            return skip_hour is not None and skip_hour(hour_start)
+
+        if self.stream:
+            hourly = [lambda day, hr, stage=stage: stage([(day, hr)]) for stage in stages + [self.__drop_hours__]]
+            self.stream_download(self.start, self.end, param, hourly, variable=variable, product=product,
+                                 skip_hour=skip)
+        else:
+            self.download(self.start, self.end, param, variable=variable, product=product, skip_hour=skip)
+            for stage in stages:
+                stage(self.__hours__())
+        self.check_tasks()
+        self.clean_root_dir(directory=self.workspace)
+
+    def __active_boxes__(self, start:datetime, end:datetime=None):
+        """Boxes to process for granules between start and end"""
+        return self.boxes
+
+    def __drop_hours__(self, hours):
+        for day, hr in hours:
+            shutil.rmtree(os.path.join(self.workspace, str(day), str(hr)))
+            self.catalog.drop_hour(day, hr)
 
-                        gdal.Warp(f"{self.root_dir}/{box.id}/wld_map/{file_path}",
-                                  f"{directory}/{file}",
-                                  options=options)
-        self.clean_root_dir()
-                    
-    def __index_bbox__(self):
-        box_cover_map, box_file_map = {}, {}
-        for box in self.boxes:
-            day_cover_map, day_file_map = {}, {}
-            for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/{box.id}/"):
-                hrs_cover_map, hrs_file_map  = {}, {}
-                for hr in os.listdir(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/{box.id}/{day}"):
-                    cloud_cover, cloud_file = -1, None
-                    for file in os.listdir(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/{box.id}/{day}/{hr}"):
-                        im = Image.open(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/{box.id}/{day}/{hr}/{file}")
-                        imarray = np.array(im)
-                        shape = imarray.shape
-                        unique, counts = np.unique(imarray, return_counts=True)
-                        nc_dict = dict(zip(unique, counts))
-                        density = nc_dict.get(0.0, 1) / (shape[0] * shape[1])
-                        if density > cloud_cover:
-                            cloud_cover = max(cloud_cover, density)
-                            cloud_file = file
-                    hrs_cover_map[hr] = cloud_cover
-                    hrs_file_map[hr] = cloud_file
-                day_cover_map[day] = hrs_cover_map
-                day_file_map[day] = hrs_file_map
-            box_cover_map[box] = day_cover_map
-            box_file_map[box] = day_file_map
-        self.box_cover_map = box_cover_map
-        self.box_file_map = box_file_map
-        shutil.rmtree(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/")
+    def wildfire_map(self):
+        self.run_layers("ABI-L2-FDCC", [("wld_map", "wildfire")])
+
+    def __granules__(self, hours, layers):
+        for day, hr in hours:
+            for granule in self.catalog.granules(day, hr):
+                yield day, hr, granule.directory, granule.file
+
+    def __warp_hours__(self, hours, layers):
+        # One task per granule, for the boxes whose clearest scan of the hour it is
+        tasks, hour_of = [], {}
+        for day, hr, directory, file in self.__granules__(hours, layers):
+            box_ids = [box.id for box in self.__cloud_boxes__(day, hr, file)]
+            if not box_ids:
+                self.processor.close_layers(directory, file, {})
+                continue
+            tasks.append((directory, file, layers, box_ids, self.filename(file), self.fire_records, self.keep_outputs))
+            hour_of[file] = (day, hr)
+
+        for (_, file, *_), (written, records) in self.run_tasks("warp_task", tasks):
+            self.sink_outputs(file, written)
+            self.store_fire_pixels(file, records)
+            day, hr = hour_of[file]
+            for save_location, _ in layers:
+                self.manifest.mark(save_location, day, hr, self.granule_id(file), "warped")
+
+    def __cloud_boxes__(self, day, hr, file):
+        start_time = self.catalog.parse(file).start_time
+        clearest = self.catalog.boxes_at(start_time)
+        return [box for box in self.__active_boxes__(start_time) if box.id in clearest]
+
+    def __index_bboxes__(self, hours):
+        tasks, hour_of, boxes_of = [], {}, {}
+        for day, hr, directory, file in self.__granules__(hours, [("dqf", "DQF")]):
+            start_time = self.catalog.parse(file).start_time
+            box_ids = [box.id for box in self.__active_boxes__(start_time)]
+            if not box_ids:
+                self.processor.close_layers(directory, file, {})
+                continue
+            tasks.append((directory, file, box_ids))
+            hour_of[file] = hour_key(start_time)
+            boxes_of.setdefault(hour_of[file], set()).update(box_ids)
+
+        pending = {hour: list(hour_of.values()).count(hour) for hour in set(hour_of.values())}
+        for (_, file, _), fractions in self.run_tasks("cloud_task", tasks):
+            self.index_clouds(file, fractions)
+            pending[hour_of[file]] -= 1
+
+        # Hours still receiving granules, or with failed tasks, are scored again next time
+        for hour, left in pending.items():
+            if left == 0 and CloudIndex.closed(hour):
+                self.cloud_index.mark_indexed(boxes_of[hour], [hour])
 
     def __bbox_cloud_covers__(self):
-        self.download(self.start, self.end, "ABI-L2-ACHAC", latest=False)
-        for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}"):
-            for hour in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                for file in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}/{hour}"):
-                    directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hour}"
-                    layer = gdal.Open("NETCDF:{0}:{1}".format(f"{directory}/{file}", "DQF"))
-                    options = gdal.TranslateOptions(format="GTiff")
-                    file_name = file.replace('.nc', '.tif')
-                    gdal.Translate(f"{directory}/{file_name}", layer, options=options)
-                    os.remove(f"{directory}/{file}")
-
-        os.mkdir(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}")
-        for box in self.boxes:
-            os.mkdir(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/{box.id}")
-            for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}"):
-                os.mkdir(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/{box.id}/{day}")
-                for hour in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                    os.mkdir(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/{box.id}/{day}/{hour}")
+        indexed = {}
 
-        OutSR = osr.SpatialReference()
-        OutSR.SetFromUserInput("ESRI:102498")
+        def skip_hour(hour_start):
+            box_ids = frozenset(box.id for box in self.__active_boxes__(hour_start, hour_start + HOUR))
+            if box_ids not in indexed:
+                indexed[box_ids] = self.cloud_index.indexed_hours(box_ids)
+            return hour_key(hour_start) in indexed[box_ids]
 
-        for box in self.boxes:
-            for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}"):
-                for hour in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                    directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hour}"
-                    for file in os.listdir(directory):
-                        options = gdal.WarpOptions(format="GTiff",
-                                                   srcSRS=OutSR,
-                                                   dstSRS=OutSR,
-                                                   cutlineDSName=f"{box.path}",
-                                                   cropToCutline=True,
-                                                   copyMetadata=True)
-
-                        gdal.Warp(f"{self.root_dir}/{self.tmp_dir}_{self.tmp_dir}/{box.id}/{day}/{hour}/{file}",
-                                  f"{directory}/{file}",
-                                  options=options)
-        self.clean_root_dir()
+        self.__process__("ABI-L2-ACHAC", [("dqf", "DQF")], None, [self.__index_bboxes__], skip_hour=skip_hour)
+        self.catalog.assign(self.cloud_index.clearest(self.start, self.end))
 
     def run(self, param, save_location, band):
-        self.download(self.start, self.end, param, latest=False)
+        self.run_layers(param, [(save_location, band)])
+
+    def run_layers(self, param, layers):
+        """
+        Downloads `param` once and extracts every (save_location, band) layer from each
+        granule in a single pass. band is a NetCDF variable (Mask, Area, Power, Temp, HT, DQF)
+        or a layer derived in custom_layers, e.g. "wildfire".
+        """
+        products = [save_location for save_location, _ in layers]
         for box in self.boxes:
-            if not os.path.exists(f"{self.root_dir}/{box.id}/{save_location}"):
-                os.mkdir(f"{self.root_dir}/{box.id}/{save_location}/")
-
-        OutSR = osr.SpatialReference()
-        OutSR.SetFromUserInput("ESRI:102498")
-
-        for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}/"):
-            for hr in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                for file in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"):
-                    directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"
-                    layer = gdal.Open("NETCDF:{0}:{1}".format(f"{directory}/{file}", band))
-                    options = gdal.TranslateOptions(format="GTiff")
-                    file_name = file.replace('.nc', '.tif')
-                    gdal.Translate(f"{directory}/{file_name}", layer, options=options)
-                    os.remove(f"{directory}/{file}")
+            for save_location in products:
+                if not os.path.exists(f"{self.root_dir}/{box.id}/{save_location}"):
+                    os.mkdir(f"{self.root_dir}/{box.id}/{save_location}/")
 
-        for day in os.listdir(f"{self.root_dir}/{self.tmp_dir}/"):
-            for hr in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                for file in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"):
-                    directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"
-                    file_path = self.filename(file)
-                    for (box, box_path) in self.box_file_map.items():
-                        min_box_file = self.parse_filename(box_path[day][hr].replace(".tif", ""))["start_time"]
-                        if self.parse_filename(file.replace(".tif", ""))["start_time"] != min_box_file:
-                            continue
+        self.__process__(param, layers, products, [lambda hours: self.__warp_hours__(hours, layers)])
 
-                        options = gdal.WarpOptions(format="GTiff",
-                                                   srcSRS=OutSR,
-                                                   dstSRS='EPSG:3857',
-                                                   cutlineDSName=f"{box.path}",
-                                                   cropToCutline=True)
+class GoesDownloaderIndividualBboxDate(GoesDownloaderDate):
+    """
+    Downloads each box's own start_date..end_date window. Only hours where at least one
+    box is active are fetched and every granule is processed for the boxes active at its
+    start time, so a season of scattered fires does not download the idle hours between them.
+    """
+    def __init__(self, save_dir, stream:bool=False, **kwargs) -> None:
+        super().__init__(save_dir, stream=stream, read_bbox_datetime=True, **kwargs)
 
-                        gdal.Warp(f"{self.root_dir}/{box.id}/{save_location}/{file_path}",
-                                  f"{directory}/{file}", #DATA/<box.id>/<param>/day/hr/file_basename
-                                  options=options)
-        self.clean_root_dir()
-
-class GoesDownloaderIndividualBboxDate(Downloader):
-
-    def __init__(self, save_dir) -> None:
-        super().__init__(save_dir, True)
-        self.start = None
-        self.end = None
-
-        self.__date_interval_bboxs__()
-
-    def __date_interval_bboxs__(self):
-
-        date_intervals = [(box.start, box.end) for box in self.boxes]
-        self.start = min(date_intervals, key=itemgetter(0))[0]
-        self.end = max(date_intervals, key=itemgetter(1))[1]
-
-    def pre_processing(self, param, band):
-
-        logging.info("Converting .nc files to .tif")
-
-        for day in os.listdir(os.path.join(self.root_dir, self.tmp_dir)):
-            for hr in os.listdir(os.path.join(self.root_dir, self.tmp_dir, day)):
-                for file in os.listdir(os.path.join(self.root_dir, self.tmp_dir, day, hr)):
-                    directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"
-
-                    if file.endswith('.nc'):
-                        layer = gdal.Open("NETCDF:{0}:{1}".format(f"{directory}/{file}", band))
-                        options = gdal.TranslateOptions(format="GTiff")
-                        file_name = self.filename(file.replace('.nc', '.tif'))
-
-                        gdal.Translate(f"{directory}/{file_name}", layer, options=options)
-                        os.remove(f"{directory}/{file}")
-        
-        logging.info("Performing cloud masking")
-        if param != 'ABI-L2-ACMC':
-            # TODO- Use cloud masks (present in args.save/cloud_mask) on these images and perform interpolation to fill no data values
-            image = Image.open(f"{directory}/{file_name}")
-            width,height = image.size
-            pixel_data = image.load()
-            pass
-
-    def crop_images_for_bboxs(self, param):
-       if param != 'ABI-L2-ACMC':
-            # TODO- Crop images
-            OutSR = osr.SpatialReference()
-            OutSR.SetFromUserInput("ESRI:102498")
-            startDay = 244
-            endDay = 244
-            startHr = 0
-            endHr = 3
-            for day in range(startDay,endDay+1):
-                day = os.listdir(f"{self.root_dir}/{self.tmp_dir}/")
-                if day<startDay or day>endDay:
-                    continue
-                for hr in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}"):
-                    if day==startDay and hr<startHr or day==endDay and hr>endHr:
-                        continue
-
-                    for file in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"):
-                        directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hr}"
-                        file_path = self.filename(file)
-                        for (box, box_path) in self.box_file_map.items():
-                            min_box_file = self.parse_filename(box_path[day][hr].replace(".tif", ""))["start_time"]
-                            if self.parse_filename(file.replace(".tif", ""))["start_time"] != min_box_file:
-                                continue
-
-                            options = gdal.WarpOptions(format="GTiff",
-                                                    srcSRS=OutSR,
-                                                    dstSRS='EPSG:3857',
-                                                    cutlineDSName=f"{box.path}",
-                                                    cropToCutline=True)
-
-                            gdal.Warp(f"{self.root_dir}/{box.id}/{param}/{day}/{hr}/{file_path}",
-                                  f"{directory}/{file}", #DATA/<box.id>/<param>/day/hr/file_basename
-                                  options=options)
-            
-            pass
+    def __bbox_cloud_covers__(self):
+        # Runs from GoesDownloaderDate.__init__, once the boxes are loaded
+        self.schedule = BoxSchedule(self.boxes)
+        self.start, self.end = self.schedule.start, self.schedule.end
+        if self.start is None:
+            raise ValueError("No box has a start and end date")
+        logging.info(f"{len(self.schedule.intervals)} box windows merged into {len(self.schedule.windows)} "
+                     f"between {self.start} and {self.end}")
+        super().__bbox_cloud_covers__()
+
+    def __active_boxes__(self, start:datetime, end:datetime=None):
+        return self.schedule.active(start, end)
 
 if __name__ == "__main__":
     down = GoesDownloaderDate("/tmp/DATA", datetime(2023, 9, 30), datetime(2023, 10, 2))
-    down.wildfire_map()
     down.run("ABI-L2-ACHAC", "cloud", "HT")
-    down.run("ABI-L2-FDCC", "mask", "Mask")
-    down.run("ABI-L2-FDCC", "area", "Area")
-    down.run("ABI-L2-FDCC", "power", "Power")
-    down.run("ABI-L2-FDCC", "temp", "Temp") 
-
-    GoesDownloaderIndividualBboxDate.crop_images_for_bboxs()
\ No newline at end of file
+    down.run_layers("ABI-L2-FDCC", [("wld_map", "wildfire"),
+                                    ("mask", "Mask"),
+                                    ("area", "Area"),
+                                    ("power", "Power"),
+                                    ("temp", "Temp")])
\ No newline at end of file
@@ -1,14 +1,14 @@
-from datetime import datetime
-from osgeo import gdal
+from datetime import datetime, timedelta
+import time
+import shutil
 import numpy as np
 import os
-import json
-from osgeo import osr
-from PIL import Image
 import logging
 import argparse
+from collections import deque
 from Downloader import Downloader
-from custom_layers import wildfire_area
+from cloud_index import hour_key
+from workers import FIRE_VARIABLES
 
 logging.basicConfig(level=logging.INFO,
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -18,151 +18,164 @@ logging.basicConfig(level=logging.INFO,
 )
 
 class GoesDownloaderLatest(Downloader):
-    def __init__(self, save_dir) -> None:
-        super().__init__(save_dir)
+    def __init__(self, save_dir, daemon:bool=False, **kwargs) -> None:
+        super().__init__(save_dir, **kwargs)
 
-        logging.info("Calculating latest cloud cover")
-        self.__bbox_cloud_covers__()
+        # Latencies of the last day of 5-minute granules
+        self.latencies = deque(maxlen=288)
+
+        # The daemon scores cloud cover per granule as they arrive
+        if not daemon:
+            logging.info("Calculating latest cloud cover")
+            self.__bbox_cloud_covers__()
 
     def wildfire_map(self):
-        self.download(datetime.now(), datetime.now(), "ABI-L2-FDCC", latest=True)
-        for box in self.boxes:
-            if not os.path.exists(f"{self.root_dir}/{box.id}/wld_map"):
-                os.mkdir(f"{self.root_dir}/{box.id}/wld_map/")
-        day = os.listdir(f"{self.root_dir}/{self.tmp_dir}/")[0]
-        hour = os.listdir(f"{self.root_dir}/{self.tmp_dir}//{day}")[0]
-        directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hour}/"
-
-        for file in os.listdir(directory):
-           wildfire_area(f"{directory}/{file}", directory)
-           os.remove(f"{directory}/{file}")
-
-        for file in os.listdir(directory):
-            layer = gdal.Open(f"{directory}/{file}")
-            options = gdal.TranslateOptions(format="GTiff")
-            file_name = file.replace('.nc', '.tif')
-            gdal.Translate(f"{directory}/{file_name}", layer, options=options)
-            os.remove(f"{directory}/{file}")
-
-        OutSR = osr.SpatialReference()
-        OutSR.SetFromUserInput("ESRI:102498")
-
-        for file in os.listdir(directory):
-            file_path = self.filename(file)
-            for (box, box_file) in self.bbox_cloud_cover.items():
-                min_box_file = self.parse_filename(box_file.replace(".tif", ""))["start_time"]
-                if self.parse_filename(file.replace(".tif", ""))["start_time"] != min_box_file:
-                    continue
-                    
-                options = gdal.WarpOptions(format="GTiff",
-                                           srcSRS=OutSR,
-                                           dstSRS='EPSG:3857',
-                                           cutlineDSName=f"{box.path}",
-                                           cropToCutline=True)
-
-                gdal.Warp(f"{self.root_dir}/{box.id}/wld_map/{file_path}",
-                          f"{directory}/{file}",
-                          options=options)
-        self.clean_root_dir()
+        self.run_layers("ABI-L2-FDCC", [("wld_map", "wildfire")])
+
+    def __latest_granules__(self):
+        """Granules of the latest hour, as downloaded by the last download()"""
+        hours = self.catalog.hours()
+        return self.catalog.granules(*hours[-1]) if hours else []
 
     def __bbox_cloud_covers__(self):
-        self.download(datetime.now(), datetime.now(), "ABI-L2-ACHAC", latest=True)
-        bbox_lowest_cloud_path = {}
-        bbox_lowest_cloud_value = {}
-
-        day = os.listdir(f"{self.root_dir}/{self.tmp_dir}/")[0]
-        hour = os.listdir(f"{self.root_dir}/{self.tmp_dir}//{day}")[0]
-        directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hour}/"
-        for file in os.listdir(directory):
-            layer = gdal.Open("NETCDF:{0}:{1}".format(f"{directory}/{file}", "DQF"))
-            options = gdal.TranslateOptions(format="GTiff")
-            file_name = file.replace('.nc', '.tif')
-            gdal.Translate(f"{directory}/{file_name}", layer, options=options)
-            os.remove(f"{directory}/{file}")
-
-        OutSR = osr.SpatialReference()
-        OutSR.SetFromUserInput("ESRI:102498")
-        for box in self.boxes:
-            os.mkdir(f"{self.root_dir}/{self.tmp_dir}/{box.id}")
-            cloud_cover, cloud_file = -1, None
-            for file in os.listdir(directory):
-                options = gdal.WarpOptions(format="GTiff",
-                                           srcSRS=OutSR,
-                                           dstSRS=OutSR,
-                                           cutlineDSName=f"{box.path}",
-                                           cropToCutline=True,
-                                           copyMetadata=True)
-
-                gdal.Warp(f"{self.root_dir}/{self.tmp_dir}/{box.id}/{file}",
-                          f"{directory}/{file}",
-                          options=options)
-
-            for bbox in os.listdir(f"{self.root_dir}/{self.tmp_dir}/{box.id}/"):
-                im = Image.open(f"{self.root_dir}/{self.tmp_dir}/{box.id}/{bbox}")
-                imarray = np.array(im)
-                shape = imarray.shape
-                unique, counts = np.unique(imarray, return_counts=True)
-                nc_dict = dict(zip(unique, counts))
-                density = nc_dict.get(0.0, 1) / (shape[0] * shape[1])
-                if density > cloud_cover:
-                    cloud_cover = max(cloud_cover, density)
-                    cloud_file = bbox
-            bbox_lowest_cloud_path[box] = cloud_file
-            bbox_lowest_cloud_value[box.id] = cloud_cover
-        self.bbox_cloud_cover = bbox_lowest_cloud_path
-        self.bbox_cloud_value = bbox_lowest_cloud_value
+        layers = [("dqf", "DQF")]
+        self.download(datetime.now(), datetime.now(), "ABI-L2-ACHAC", latest=True, variable=layers)
+
+        tasks = [(granule.directory, granule.file) for granule in self.__latest_granules__()]
+        start_times = [self.index_clouds(file, fractions) for (_, file), fractions in self.run_tasks("cloud_task", tasks)]
+        self.check_tasks()
+
+        clearest = {}
+        if start_times:
+            hour = hour_key(max(start_times))
+            clearest = {box_id: hours[hour] for box_id, hours in self.cloud_index.clearest(max(start_times), max(start_times)).items()
+                        if hour in hours}
+        self.catalog.assign({box_id: {hour: scan} for box_id, scan in clearest.items()})
+        # Start time of the clearest scan of the hour for every box, None when no scan covers it
+        self.bbox_cloud_cover = {box: clearest[box.id][1] if box.id in clearest else None for box in self.boxes}
+        self.bbox_cloud_value = {box.id: clearest[box.id][0] if box.id in clearest else -1 for box in self.boxes}
         self.clean_root_dir()
 
     def run(self, param, save_location, band):
-        self.download(datetime.now(), datetime.now(), param, latest=True)
+        self.run_layers(param, [(save_location, band)])
+
+    def run_layers(self, param, layers):
+        """Downloads the latest hour of `param` once and extracts every (save_location, band) layer in one pass"""
+        self.download(datetime.now(), datetime.now(), param, latest=True, variable=layers)
         for box in self.boxes:
-            if not os.path.exists(f"{self.root_dir}/{box.id}/{save_location}"):
-                os.mkdir(f"{self.root_dir}/{box.id}/{save_location}/")
-
-        OutSR = osr.SpatialReference()
-        OutSR.SetFromUserInput("ESRI:102498")
-
-        day = os.listdir(f"{self.root_dir}/{self.tmp_dir}/")[0]
-        hour = os.listdir(f"{self.root_dir}/{self.tmp_dir}/{day}")[0]
-        directory = f"{self.root_dir}/{self.tmp_dir}/{day}/{hour}/"
-        for file in os.listdir(directory):
-            layer = gdal.Open("NETCDF:{0}:{1}".format(f"{directory}/{file}", band))
-            options = gdal.TranslateOptions(format="GTiff")
-            file_name = file.replace('.nc', '.tif')
-            gdal.Translate(f"{directory}/{file_name}", layer, options=options)
-            os.remove(f"{directory}/{file}")
-
-        for file in os.listdir(directory):
-            file_path = self.filename(file)
-            for (box, box_file) in self.bbox_cloud_cover.items():
-                min_box_file = self.parse_filename(box_file.replace(".tif", ""))["start_time"]
-                if self.parse_filename(file.replace(".tif", ""))["start_time"] != min_box_file:
-                    continue
-                    
-                options = gdal.WarpOptions(format="GTiff",
-                                           srcSRS=OutSR,
-                                           dstSRS='EPSG:3857',
-                                           cutlineDSName=f"{box.path}",
-                                           cropToCutline=True)
-
-                gdal.Warp(f"{self.root_dir}/{box.id}/{save_location}/{file_path}",
-                          f"{directory}/{file}",
-                          options=options)
+            for save_location, _ in layers:
+                if not os.path.exists(f"{self.root_dir}/{box.id}/{save_location}"):
+                    os.mkdir(f"{self.root_dir}/{box.id}/{save_location}/")
+
+        tasks = []
+        for granule in self.__latest_granules__():
+            box_ids = list(self.catalog.boxes_at(granule.start_time))
+            if box_ids:
+                tasks.append((granule.directory, granule.file, layers, box_ids, granule.name, self.fire_records,
+                              self.keep_outputs))
+        for (_, file, *_), (written, records) in self.run_tasks("warp_task", tasks):
+            self.sink_outputs(file, written)
+            self.store_fire_pixels(file, records)
+        self.check_tasks()
         self.clean_root_dir()
 
-    def cloud_json(self):
-        if not os.path.exists(f"{self.root_dir}/{self.json_file}"):
-            empty_json = {}
-            with open(f"{self.root_dir}/{self.json_file}", "w") as f:
-                json.dump(empty_json, f)
-
-        with open(f"{self.root_dir}/{self.json_file}", "r") as f:
-            data = json.load(f)
+    def serve(self, poll_interval:int=300, layers=(("ABI-L2-ACHAC", "cloud", "HT"), ("ABI-L2-FDCC", "mask", "Mask"))):
+        """
+        Polls S3 every `poll_interval` seconds and processes every new FDCC granule, with
+        the ACHAC granule of the same scan, as soon as both have landed. Projections, bbox
+        geometry, the S3 session and listings stay warm between polls.
+        """
+        self.listing.ttl = min(self.listing.ttl, poll_interval // 2)
+        logging.info(f"Serving latest granules every {poll_interval} seconds")
+        while True:
+            started = time.monotonic()
+            try:
+                self.poll(layers)
+            except Exception as e:
+                logging.error(e, exc_info=True)
+            time.sleep(max(poll_interval - (time.monotonic() - started), 0))
+
+    def poll(self, layers):
+        now = datetime.utcnow()
+        cloud_keys = {self.catalog.parse(key).start_time: key for key in self.__recent_keys__("ABI-L2-ACHAC", now)}
+
+        for key in self.__recent_keys__("ABI-L2-FDCC", now):
+            file = os.path.basename(key)
+            if self.manifest.done("wld_map", self.granule_id(file), "warped"):
+                continue
+            start_time = self.catalog.parse(file).start_time
+            if start_time not in cloud_keys:
+                logging.info(f"Waiting for the ACHAC granule of {start_time}")
+                continue
+            self.process_granule(key, cloud_keys[start_time], layers)
+
+    def __recent_keys__(self, param, now):
+        # The previous hour is listed too, its last granules land after the hour turns
+        keys = []
+        for t in (now - timedelta(hours=1), now):
+            prefix = f"s3://noaa-goes16/{param}/{t.year}/{str(t.timetuple().tm_yday).zfill(3)}/{str(t.hour).zfill(2)}/"
+            try:
+                keys += self.listing.ls(prefix)
+            except FileNotFoundError:
+                pass
+        return sorted(keys)
+
+    def process_granule(self, fire_key, cloud_key, layers):
+        fire_file = os.path.basename(fire_key)
+        params = self.catalog.parse(fire_file)
+        granule = params.id
+        day, hour = params.start_time.timetuple().tm_yday, params.start_time.hour
+        directory = os.path.join(self.root_dir, self.tmp_dir, "daemon", granule)
+        keys = {"ABI-L2-FDCC": fire_key, "ABI-L2-ACHAC": cloud_key}
+
+        # One pass over each granule extracts everything it is needed for
+        granule_layers = {"ABI-L2-ACHAC": [("dqf", "DQF")], "ABI-L2-FDCC": [("wld_map", "wildfire")]}
+        for param, save_location, band in layers:
+            granule_layers[param].append((save_location, band))
+        if self.fire_records and not self.remote_read:
+            granule_layers["ABI-L2-FDCC"] += FIRE_VARIABLES
+
+        try:
+            for param, key in keys.items():
+                for file, paths in self.__granule_sources__(key, granule_layers[param], os.path.join(directory, param)):
+                    if "dqf" in paths:
+                        fractions = {box.id: fraction for box, fraction in
+                                     self.clear_fractions(self.reprojector.read(paths["dqf"])).items()}
+                        self.index_clouds(file, fractions)
+                        self.bbox_cloud_value = {box.id: fractions.get(box.id, -1) for box in self.boxes}
+                        self.cloud_json(params.start_time)
+
+                    for save_location, path in paths.items():
+                        if save_location == "dqf" or save_location.startswith("_"):
+                            continue
+                        self.sink_outputs(file, self.__warp_boxes__(path, save_location))
+                        self.manifest.mark(save_location, day, hour, granule, "warped")
+                    if "wld_map" in paths and self.fire_records and file.endswith(".nc"):
+                        self.store_fire_pixels(file, self.processor.fire_pixels(paths, self.boxes, "wld_map"))
+            if self.composites is not None:
+                self.composites.flush()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+            self.catalog.clear()
+
+        latency = (datetime.utcnow() - params.end_time).total_seconds()
+        self.latencies.append(latency)
+        logging.info(f"Granule {granule} available {latency:.0f}s after end of scan "
+                     f"(last {len(self.latencies)}: mean {np.mean(self.latencies):.0f}s, max {np.max(self.latencies):.0f}s)")
+
+    def __granule_sources__(self, key, layers, directory):
+        os.makedirs(directory, exist_ok=True)
+        local_name, getter = self.__getter__(layers, None)
+        getter(key, os.path.join(directory, local_name(os.path.basename(key))))
+        return self.layer_sources(directory, layers)
+
+    def __warp_boxes__(self, path, save_location):
+        for box in self.boxes:
+            os.makedirs(f"{self.root_dir}/{box.id}/{save_location}", exist_ok=True)
+        return self.warp_boxes(path, self.boxes, save_location, self.filename(os.path.basename(path)))
 
-        with open(f"{self.root_dir}/{self.json_file}", "w") as f:
-            data[str(datetime.now())] = self.bbox_cloud_value
-            logging.info("Saving JSON file")
-            json.dump(data, f)
+    def cloud_json(self, timestamp:datetime=None):
+        self.cloud_series.append(str(timestamp or datetime.now()), self.bbox_cloud_value)
             
 
 if __name__ == "__main__":
@@ -178,10 +191,12 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     down = GoesDownloaderLatest(args.save)
-    down.wildfire_map()
     down.run("ABI-L2-ACHAC", "cloud", "HT")
-    down.run("ABI-L2-FDCC", "mask", "Mask")
-    #down.run("ABI-L2-FDCC", "area", "Area")
-    #down.run("ABI-L2-FDCC", "power", "Power")
-    #down.run("ABI-L2-FDCC", "temp", "Temp")
+    down.run_layers("ABI-L2-FDCC", [("wld_map", "wildfire"),
+                                    ("mask", "Mask"),
+                                    #("area", "Area"),
+                                    #("power", "Power"),
+                                    #("temp", "Temp"),
+                                    ])
     down.cloud_json()
+    down.cloud_series.export_json(f"{down.root_dir}/{down.json_file}")
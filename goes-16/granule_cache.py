@@ -0,0 +1,117 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+
+from store import SQLiteStore
+
+
+class GranuleCache(SQLiteStore):
+    """
+    Content-addressed store of whole S3 granules shared by every run and product.
+    Entries are keyed by S3 key + ETag + size, verified against the ETag when it
+    is a plain MD5, and evicted least recently used first above `max_bytes`.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS granules (
+            digest TEXT PRIMARY KEY,
+            s3_key TEXT NOT NULL,
+            etag TEXT,
+            size INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS granules_last_access ON granules (last_access);
+    """
+
+    def __init__(self, fs, cache_dir, max_bytes:int, info=None) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        super().__init__(os.path.join(cache_dir, "granules.sqlite"))
+        self.fs = fs
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.info = info or fs.info
+        self.stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+
+    @staticmethod
+    def digest(key, etag, size):
+        return hashlib.sha256(f"{key}|{etag}|{size}".encode()).hexdigest()
+
+    @staticmethod
+    def md5(path):
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def get(self, key, local_path):
+        info = self.info(key)
+        etag = (info.get("ETag") or "").strip('"')
+        size = info["size"]
+        digest = self.digest(key, etag, size)
+
+        rows = self.execute("SELECT path FROM granules WHERE digest=?", (digest,))
+        if rows and os.path.exists(rows[0][0]) and os.path.getsize(rows[0][0]) == size:
+            cached = rows[0][0]
+            self.execute("UPDATE granules SET last_access=? WHERE digest=?", (time.time(), digest))
+            with self.stats_lock:
+                self.hits += 1
+                self.bytes_served += size
+        else:
+            cached = self.__insert__(key, etag, size, digest)
+            with self.stats_lock:
+                self.misses += 1
+
+        self.__link__(cached, local_path)
+        return local_path
+
+    def __insert__(self, key, etag, size, digest):
+        cached = os.path.join(self.cache_dir, digest[:2], digest)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        partial = f"{cached}.{threading.get_ident()}.part"
+        self.fs.get(key, partial)
+
+        if os.path.getsize(partial) != size or (etag and "-" not in etag and self.md5(partial) != etag):
+            os.remove(partial)
+            raise OSError(f"Integrity check failed for {key}")
+
+        os.replace(partial, cached)
+        self.execute("INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?, ?)",
+                     (digest, key, etag, size, cached, time.time()))
+        self.evict(keep=digest)
+        return cached
+
+    def __link__(self, cached, local_path):
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        try:
+            # Hard links keep the cached copy alive when tmp/ is wiped
+            os.link(cached, local_path)
+        except OSError:
+            shutil.copyfile(cached, local_path)
+
+    def evict(self, keep=None):
+        with self.lock:
+            total = self.execute("SELECT COALESCE(SUM(size), 0) FROM granules")[0][0]
+            if total <= self.max_bytes:
+                return
+            for digest, path, size in self.execute("SELECT digest, path, size FROM granules ORDER BY last_access"):
+                if total <= self.max_bytes:
+                    break
+                if digest == keep:
+                    continue
+                if os.path.exists(path):
+                    os.remove(path)
+                self.execute("DELETE FROM granules WHERE digest=?", (digest,))
+                total -= size
+                logging.debug(f"Evicted {path} from granule cache")
+
+    def log_stats(self):
+        logging.info(f"Granule cache: {self.hits} hits, {self.misses} misses, "
+                     f"{self.bytes_served / (1024 * 1024):.1f} MB served locally")
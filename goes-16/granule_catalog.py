@@ -0,0 +1,123 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+
+def parse_time(field:str) -> datetime:
+    """GOES `YYYYjjjHHMMSSf` time, without strptime"""
+    return datetime(int(field[0:4]), 1, 1) + timedelta(days=int(field[4:7]) - 1,
+                                                       hours=int(field[7:9]),
+                                                       minutes=int(field[9:11]),
+                                                       seconds=int(field[11:13]),
+                                                       microseconds=int(field[13:].ljust(6, "0")[:6] or 0))
+
+
+class Granule:
+    """One GOES granule parsed from its file name, and where it was downloaded to"""
+    __slots__ = ("file", "product", "channel", "satellite_id", "start_time", "end_time", "creation_time",
+                 "directory", "day", "hour")
+
+    def __init__(self, file, product, channel, satellite_id, start_time, end_time, creation_time) -> None:
+        self.file = file
+        self.product = product
+        self.channel = channel
+        self.satellite_id = satellite_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.creation_time = creation_time
+        self.directory = None
+        self.day = None
+        self.hour = None
+
+    @classmethod
+    def parse(cls, file):
+        stem = os.path.splitext(os.path.basename(file))[0]
+        if stem.startswith("OR_"):
+            stem = stem[3:]
+        parts = stem.split('_')
+        if len(parts) != 5:
+            raise ValueError(f"Invalid filename format: {file}")
+        return cls(os.path.basename(file), parts[0].rsplit("-", 1)[0], parts[0][-3:], parts[1],
+                   parse_time(parts[2][1:]), parse_time(parts[3][1:]), parse_time(parts[4][1:]))
+
+    @property
+    def name(self):
+        """Output file name, e.g. 20231001T120020800000Z.tif"""
+        return f"{self.start_time:%Y%m%dT%H%M%S}{str(self.start_time.microsecond).zfill(3)}Z.tif"
+
+    @property
+    def id(self):
+        return self.name.replace(".tif", "")
+
+    def as_dict(self):
+        return {"channel": self.channel, "satellite_id": self.satellite_id, "start_time": self.start_time,
+                "end_time": self.end_time, "creation_time": self.creation_time}
+
+
+class GranuleCatalog:
+    """
+    In-memory catalog of the granules of a run, shared by every stage. Names are parsed
+    once, downloaded granules are indexed by workspace hour, and the boxes assigned to
+    each clearest scan by its start time.
+    """
+    max_parsed = 100000
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.parsed = {}
+        self.by_hour = {}
+        self.boxes_by_start = {}
+
+    def parse(self, file) -> Granule:
+        key = os.path.splitext(os.path.basename(file))[0]
+        granule = self.parsed.get(key)
+        if granule is None:
+            granule = Granule.parse(file)
+            with self.lock:
+                if len(self.parsed) >= self.max_parsed:
+                    self.parsed = {g.file.rsplit(".", 1)[0]: g for hour in self.by_hour.values() for g in hour.values()}
+                granule = self.parsed.setdefault(key, granule)
+        return granule
+
+    def add(self, local_path, day, hour) -> Granule:
+        """Records the granule downloaded to <workspace>/<day>/<hour>/<file>"""
+        granule = self.parse(local_path)
+        with self.lock:
+            granule.file = os.path.basename(local_path)
+            granule.directory = os.path.dirname(local_path)
+            granule.day, granule.hour = str(day), str(hour)
+            self.by_hour.setdefault((granule.day, granule.hour), {})[granule.file] = granule
+        return granule
+
+    def hours(self):
+        """Workspace (day, hour) pairs holding granules, in time order"""
+        with self.lock:
+            return sorted(self.by_hour, key=lambda key: min(g.start_time for g in self.by_hour[key].values()))
+
+    def granules(self, day, hour):
+        """Granules of one workspace hour: downloaded NetCDF first, then remote-read layers"""
+        with self.lock:
+            granules = list(self.by_hour.get((str(day), str(hour)), {}).values())
+        return sorted(granules, key=lambda g: (not g.file.endswith('.nc'), g.file))
+
+    def drop_hour(self, day, hour):
+        with self.lock:
+            self.by_hour.pop((str(day), str(hour)), None)
+
+    def clear(self):
+        with self.lock:
+            self.by_hour.clear()
+
+    def assign(self, clearest):
+        """
+        Indexes the clearest scan of every box and hour, {box id: {hour: (fraction, start_time, file)}}
+        from cloud_index.CloudIndex.clearest, so boxes_at() is one lookup per granule.
+        """
+        self.boxes_by_start = {}
+        for box_id, hours in clearest.items():
+            for _, start_time, _ in hours.values():
+                self.boxes_by_start.setdefault(start_time, set()).add(box_id)
+
+    def boxes_at(self, start_time) -> set:
+        """Ids of the boxes whose clearest scan started at start_time"""
+        return self.boxes_by_start.get(start_time, set())
@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from store import SQLiteStore
+
+
+class ListingIndex(SQLiteStore):
+    """
+    On-disk cache of `fs.ls` results for s3://noaa-goes16/{product}/{year}/{day}/{hour}/
+    prefixes. Listings of periods that ended more than `closed_after` ago never
+    change and are kept forever, everything else expires after `ttl` seconds.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS listings (
+            product TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            entries TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            closed INTEGER NOT NULL,
+            PRIMARY KEY (product, year, day, hour)
+        );
+    """
+
+    def __init__(self, fs, db_path, ttl:int=300, closed_after:timedelta=timedelta(hours=1)) -> None:
+        super().__init__(db_path)
+        self.fs = fs
+        self.ttl = ttl
+        self.closed_after = closed_after
+        self.stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def parse_prefix(path):
+        """Splits an S3 prefix into (bucket, product, year, day, hour), -1 for missing levels"""
+        parts = [p for p in path.replace("s3://", "").split("/") if p]
+        bucket, product = parts[0], parts[1]
+        levels = [int(p) for p in parts[2:5]]
+        levels += [-1] * (3 - len(levels))
+        return (bucket, product, *levels)
+
+    @staticmethod
+    def period_end(year, day, hour):
+        if year < 0:
+            return None
+        if day < 0:
+            return datetime(year + 1, 1, 1)
+        day_start = datetime(year, 1, 1) + timedelta(days=day - 1)
+        if hour < 0:
+            return day_start + timedelta(days=1)
+        return day_start + timedelta(hours=hour + 1)
+
+    def is_closed(self, year, day, hour):
+        end = self.period_end(year, day, hour)
+        return end is not None and datetime.utcnow() >= end + self.closed_after
+
+    def ls(self, path, detail:bool=False):
+        _, product, year, day, hour = self.parse_prefix(path)
+        rows = self.execute("SELECT entries, fetched_at, closed FROM listings WHERE product=? AND year=? AND day=? AND hour=?",
+                            (product, year, day, hour))
+        if rows:
+            entries, fetched_at, closed = rows[0]
+            if closed or time.time() - fetched_at < self.ttl:
+                with self.stats_lock:
+                    self.hits += 1
+                return self.__as_listing__(json.loads(entries), detail)
+
+        with self.stats_lock:
+            self.misses += 1
+        listing = self.fs.ls(path, detail=True, refresh=True)
+        entries = [{"name": e["name"], "size": e.get("size", 0), "ETag": e.get("ETag")} for e in listing]
+        self.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (product, year, day, hour, json.dumps(entries), time.time(), int(self.is_closed(year, day, hour))))
+        return self.__as_listing__(entries, detail)
+
+    def info(self, key):
+        """Size and ETag of an object, answered from its parent prefix listing"""
+        name = key.replace("s3://", "")
+        for entry in self.ls(f"s3://{os.path.dirname(name)}/", detail=True):
+            if entry["name"].rstrip("/") == name:
+                return entry
+        return self.fs.info(key)
+
+    def __as_listing__(self, entries, detail):
+        if detail:
+            return entries
+        return [e["name"] for e in entries]
+
+    def log_stats(self):
+        logging.info(f"Listing index: {self.hits} hits, {self.misses} S3 listing requests")
@@ -2,7 +2,8 @@ import os, shutil
 import argparse
 from goes_16_latest import GoesDownloaderLatest
 from goes_16_date import GoesDownloaderDate, GoesDownloaderIndividualBboxDate
-from datetime import datetime
+from cloud_series import CloudSeries
+from datetime import datetime, timedelta
 import logging
 
 logging.basicConfig(level=logging.INFO,
@@ -12,22 +13,77 @@ logging.basicConfig(level=logging.INFO,
     filemode="w"
 )
 
+def export_clouds(save_dir, days:int=None):
+    """Writes the cloud values kept under <save>/state to <save>/cloud.json, optionally only the last `days`"""
+    json_path = os.path.join(save_dir, "cloud.json")
+    series = CloudSeries(os.path.join(save_dir, "state", "cloud_series.sqlite"))
+    try:
+        series.import_json(json_path)
+        start = str(datetime.now() - timedelta(days=days)) if days else None
+        logging.info(f"Saving JSON file {json_path}")
+        series.export_json(json_path, start=start)
+    finally:
+        series.close()
+
 def main():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(help="Type of Download")
     parser.add_argument("-s", "--save", required=True)
+    parser.add_argument("-c", "--concurrency", type=int, default=4,
+                        help="Number of S3 hour prefixes, and objects within each prefix, fetched concurrently")
+    parser.add_argument("-r", "--remote-read", action='store_true',
+                        help="Read only the needed variable and bbox window of each granule from S3")
+    parser.add_argument("--cache-size", type=float, default=20,
+                        help="Disk budget in GB of the granule cache shared across runs, 0 disables it")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Processes extracting and warping granules in parallel")
+    parser.add_argument("--compress", choices=["DEFLATE", "ZSTD", "NONE"], default="DEFLATE",
+                        help="Compression of the Cloud-Optimized GeoTIFF outputs")
+    parser.add_argument("--quantize-confidence", action='store_true',
+                        help="Store the wildfire confidence as uint8 with a 0.01 scale instead of float32")
+    parser.add_argument("--datacube", action='store_true',
+                        help="Also append every output to a per-box, per-layer NetCDF datacube under <save>/cubes")
+    parser.add_argument("--composite-days", type=int, default=0,
+                        help="Keep max/mean/clear-count/first-detection composites over this many days, 0 disables them")
+    parser.add_argument("--no-fire-records", action='store_true',
+                        help="Do not keep the per-pixel fire records (coordinates, confidence, Power/Temp/Area) under <save>/fires")
+    parser.add_argument("--shared-tiles", action='store_true',
+                        help="Warp overlapping boxes once as a shared tile and slice every box out of it")
 
     latest_parser = subparsers.add_parser("latest")
 
+    daemon_parser = subparsers.add_parser("daemon")
+    daemon_parser.add_argument("-p", "--poll-interval", type=int, default=300,
+                               help="Seconds between polls for new granules")
+
+    export_parser = subparsers.add_parser("export-clouds")
+    export_parser.add_argument("--days", type=int, default=None,
+                               help="Only export the cloud values of the last N days, all of them by default")
+
     datetime_parser = subparsers.add_parser("date")
-    datetime_parser.add_argument("-d", "--date", nargs=2, type=str, required=False)
-    datetime_parser.add_argument("-g", "--geojson", action='store_false', required=False)
+    datetime_parser.add_argument("-d", "--date", nargs=2, type=str, required=False,
+                                 help="Download every box between these two YYYY-MM-DD dates")
+    datetime_parser.add_argument("-g", "--geojson", action='store_true', required=False,
+                                 help="Download each box over its own start & end dates, -d is ignored")
+    datetime_parser.add_argument("--stream", action='store_true', required=False,
+                                 help="Process each hour as soon as it is downloaded instead of after the whole range")
     args = parser.parse_args()
+    if 'days' in args:
+        export_clouds(args.save, args.days)
+        return
+    if 'date' in args and not args.geojson and args.date is None:
+        datetime_parser.error("one of -d/--date START END or -g/--geojson is required")
+    options = dict(concurrency=args.concurrency, remote_read=args.remote_read,
+                   cache_size_gb=args.cache_size, workers=args.workers, compress=args.compress,
+                   quantize=("wld_map",) if args.quantize_confidence else (), datacube=args.datacube,
+                   composite_days=args.composite_days, fire_records=not args.no_fire_records,
+                   shared_tiles=args.shared_tiles)
+    down = None
     try:
-        if 'geojson' in args:
+        if getattr(args, 'geojson', False):
             logging.info(f"Bulk Downloading based on bbox geojson start & end dates")
 
-            down = GoesDownloaderIndividualBboxDate(args.save)
+            down = GoesDownloaderIndividualBboxDate(args.save, stream=args.stream, **options)
             #down.wildfire_map()
             down.run("ABI-L2-ACHAC", "cloud", "HT")
             #down.run("ABI-L2-FDCC", "mask", "Mask")
@@ -36,31 +92,43 @@ def main():
             logging.info(f"Bulk Downloading")
             down = GoesDownloaderDate(args.save,
                                       datetime.strptime(args.date[0], '%Y-%m-%d'),
-                                      datetime.strptime(args.date[1], '%Y-%m-%d'))
-            down.wildfire_map()
+                                      datetime.strptime(args.date[1], '%Y-%m-%d'),
+                                      stream=args.stream,
+                                      **options)
             down.run("ABI-L2-ACHAC", "cloud", "HT")
-            down.run("ABI-L2-FDCC", "mask", "Mask")
-            #down.run("ABI-L2-FDCC", "area", "Area")
-            #down.run("ABI-L2-FDCC", "power", "Power")
-            #down.run("ABI-L2-FDCC", "temp", "Temp")
+            down.run_layers("ABI-L2-FDCC", [("wld_map", "wildfire"),
+                                            ("mask", "Mask"),
+                                            #("area", "Area"),
+                                            #("power", "Power"),
+                                            #("temp", "Temp"),
+                                            ])
         
+        elif 'poll_interval' in args:
+            logging.info(f"Serving latest granules {datetime.now()}")
+            down = GoesDownloaderLatest(args.save, daemon=True, **options)
+            down.serve(args.poll_interval)
+
         elif 'date' not in args:
             logging.info(f"Downloading data {datetime.now()}")
-            down = GoesDownloaderLatest(args.save)
-            down.wildfire_map()
+            down = GoesDownloaderLatest(args.save, **options)
             down.run("ABI-L2-ACHAC", "cloud", "HT")
-            down.run("ABI-L2-FDCC", "mask", "Mask")
-            #down.run("ABI-L2-FDCC", "area", "Area")
-            #down.run("ABI-L2-FDCC", "power", "Power")
-            #down.run("ABI-L2-FDCC", "temp", "Temp")
+            down.run_layers("ABI-L2-FDCC", [("wld_map", "wildfire"),
+                                            ("mask", "Mask"),
+                                            #("area", "Area"),
+                                            #("power", "Power"),
+                                            #("temp", "Temp"),
+                                            ])
             down.cloud_json()
 
         logging.info("Finished process")
+        down.clean_root_dir()
     except Exception as e:
+        # tmp/ is kept on failure so that a rerun resumes from the manifest
         logging.error(e, exc_info=True)
         raise
     finally:
-        down.clean_root_dir()
+        if down is not None:
+            down.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import os
+import time
+
+from store import SQLiteStore
+
+STATES = ("downloaded", "warped", "ingested")
+
+
+class Manifest(SQLiteStore):
+    """
+    Progress of every granule through the pipeline, per output product
+    (wld_map, mask, cloud, ...), so interrupted backfills resume where they stopped.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS granules (
+            product TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            granule TEXT NOT NULL,
+            state INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (product, granule)
+        );
+        CREATE INDEX IF NOT EXISTS granules_day_hour ON granules (product, day, hour);
+        CREATE TABLE IF NOT EXISTS workspaces (
+            directory TEXT PRIMARY KEY,
+            product TEXT NOT NULL
+        );
+    """
+
+    def state(self, product, granule):
+        rows = self.execute("SELECT state FROM granules WHERE product=? AND granule=?", (product, granule))
+        return STATES[rows[0][0]] if rows else None
+
+    def done(self, product, granule, state):
+        rows = self.execute("SELECT state FROM granules WHERE product=? AND granule=?", (product, granule))
+        return bool(rows) and rows[0][0] >= STATES.index(state)
+
+    def mark(self, product, day, hour, granule, state):
+        # States only move forward, a re-download never undoes a warp
+        self.execute("""
+            INSERT INTO granules VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (product, granule) DO UPDATE SET
+                state=MAX(state, excluded.state), updated_at=excluded.updated_at
+        """, (product, int(day), int(hour), granule, STATES.index(state), time.time()))
+
+    def mark_ingested(self, product, granule):
+        self.execute("UPDATE granules SET state=?, updated_at=? WHERE product=? AND granule=?",
+                     (STATES.index("ingested"), time.time(), product, granule))
+
+    def reset_incomplete(self, product):
+        """Forgets granules whose intermediate files were lost with the workspace"""
+        self.execute("DELETE FROM granules WHERE product=? AND state < ?", (product, STATES.index("warped")))
+
+    def claim(self, directory, product):
+        """Records `product` as the owner of a workspace directory, returning the previous owner"""
+        rows = self.execute("SELECT product FROM workspaces WHERE directory=?", (directory,))
+        self.execute("INSERT OR REPLACE INTO workspaces VALUES (?, ?)", (directory, product))
+        return rows[0][0] if rows else None
+
+    def release(self, directory):
+        """Forgets the owner of `directory` and of every workspace inside it"""
+        self.execute("DELETE FROM workspaces WHERE directory=? OR directory LIKE ?",
+                     (directory, os.path.join(directory, "%")))
@@ -6,6 +6,10 @@ import psycopg2
 import psycopg2.extras as extras
 import datetime
 
+from manifest import Manifest
+from cog import CogWriter
+from composites import DEFAULT_COMPOSITES
+
 logging.basicConfig(level=logging.DEBUG,
     format='%(asctime)s %(levelname)-8s %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S',
@@ -18,7 +22,9 @@ DATA_DIR = '/app/DATA'
 MOSAIC_DIR = '/app/geoserver/datadir/mosaic_dir'
 
 REGIONS = ['happy_camp', 'bigwood', 'carson', 'oakland']
-BANDS = ['wld_map']
+# Composite layers (<layer>_<stat>) are rewritten as their period fills up
+COMPOSITE_BANDS = [f"{layer}_{stat}" for layer, stats in DEFAULT_COMPOSITES.items() for stat in stats]
+BANDS = ['wld_map'] + COMPOSITE_BANDS
 DIRS_TO_BE_DELETED = ['cloud', 'mask', 'wld_map']
 
 POSTGRES_CONNECTION_KWARGS = {
@@ -30,8 +36,15 @@ POSTGRES_CONNECTION_KWARGS = {
 }
 connection = psycopg2.connect(**POSTGRES_CONNECTION_KWARGS)
 cursor = connection.cursor()
+manifest = Manifest(os.path.join(DATA_DIR, 'state', 'manifest.sqlite'))
+cog_writer = CogWriter()
 
 def export_files_to_mosaic_dir(region, band):
+    region_dir = os.path.join(DATA_DIR, region, band)
+    if not os.path.exists(region_dir):
+        # Composites are only written with --composite-days
+        logging.warning(f"{region_dir} not found, nothing to export")
+        return [], []
     region_mosaic_dir_name = f"{region}_{band}"
     region_mosaic_dir = os.path.join(MOSAIC_DIR, region_mosaic_dir_name)
     if not os.path.exists(region_mosaic_dir):
@@ -40,11 +53,11 @@ def export_files_to_mosaic_dir(region, band):
     else:
         logging.info(f"{region_mosaic_dir} already exists")
 
-    region_dir = os.path.join(DATA_DIR, region, band)
     files_list = [os.path.join(region_dir, file) for file in os.listdir(region_dir) if file.find('.tif') > -1]
     logging.info(f"{len(files_list)} files found in {region_dir}")
 
-    exported_files_list = []
+    is_composite = band in COMPOSITE_BANDS
+    exported_files_list, exported_granules = [], []
     for file in files_list:
         # First rename and move the files
         old_file_name = os.path.basename(file)
@@ -55,14 +68,20 @@ def export_files_to_mosaic_dir(region, band):
         new_file_name = granuel_prefix + file_name_prefix + truncated_file_timestamp_string + 'Z.tif'
         new_file_path = os.path.join(region_mosaic_dir, new_file_name)
 
-        if not os.path.exists(new_file_path):
-            os.rename(file, new_file_path)
+        if not os.path.exists(new_file_path) or is_composite:
+            if CogWriter.is_cog(file):
+                os.replace(file, new_file_path)
+            else:
+                # Written before outputs were COGs
+                cog_writer.translate(file, new_file_path)
+                os.remove(file)
             exported_files_list.append(new_file_path)
+            exported_granules.append(old_file_name.replace('.tif', ''))
         else:
             os.remove(file)
             logging.info(f"{new_file_name} already in target dir... deleting from source dir")
     logging.info(f"Files renamed successfully and moved to {region_mosaic_dir}")
-    return exported_files_list
+    return exported_files_list, exported_granules
 
 def update_db(region, band, imported_files):
     table_name = f"public.{region}_{band}"
@@ -82,7 +101,7 @@ def update_db(region, band, imported_files):
         logging.warning(f"Skipping region- {region} band- {band}")
         cursor.execute("ROLLBACK")
         connection.commit()
-        return
+        return False
     
     # Removing files from list to be imported, which are already in table
     imported_files = list(set(imported_files) - set(existing_filenames))
@@ -109,7 +128,7 @@ def update_db(region, band, imported_files):
     
     if not len(tuples):
         logging.info("No values to be inserted into table")
-        return
+        return True
 
     # Inserting tuples
     insert_query = """
@@ -118,6 +137,7 @@ def update_db(region, band, imported_files):
     cursor.execute(insert_query + args_str)
     connection.commit()
     logging.info("Successfully updated mosaic!")
+    return True
 
 def clear_downloaded_files(region):
     region_dir = os.path.join(DATA_DIR, region)
@@ -132,6 +152,8 @@ def clear_downloaded_files(region):
 if __name__ == '__main__':
     for region in REGIONS:
         for band in BANDS:
-            exported_files_list = export_files_to_mosaic_dir(region, band)
-            update_db(region, band, exported_files_list)
+            exported_files_list, exported_granules = export_files_to_mosaic_dir(region, band)
+            if update_db(region, band, exported_files_list):
+                for granule in exported_granules:
+                    manifest.mark_ingested(band, granule)
             clear_downloaded_files(region)
\ No newline at end of file
@@ -0,0 +1,59 @@
+import queue
+import logging
+import threading
+
+_DONE = object()
+
+
+class StreamingPipeline:
+    """
+    Runs items through a chain of stages, one thread per stage, connected by
+    bounded queues. Each stage is called with the previous stage's result and a
+    None result drops the item. At most `queue_size` items wait between two
+    stages, so peak disk and memory do not depend on the number of items.
+    """
+    def __init__(self, stages, queue_size:int=2) -> None:
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        failed = threading.Event()
+        errors = []
+
+        def worker(stage, inbox, outbox):
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    break
+                if failed.is_set():
+                    continue # Drain so upstream stages never block on a full queue
+                try:
+                    result = stage(item)
+                except Exception as e:
+                    logging.error(f"Pipeline stage {getattr(stage, '__name__', stage)} failed on {item}: {e}", exc_info=True)
+                    errors.append(e)
+                    failed.set()
+                    continue
+                if outbox is not None and result is not None:
+                    outbox.put(result)
+            if outbox is not None:
+                outbox.put(_DONE)
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            thread = threading.Thread(target=worker, args=(stage, queues[i], outbox), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        for item in items:
+            if failed.is_set():
+                break
+            queues[0].put(item)
+        queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
@@ -0,0 +1,64 @@
+import hashlib
+import threading
+
+import numpy as np
+from osgeo import osr
+
+
+class ProjectionService:
+    """
+    SpatialReferences and CoordinateTransformations built once per definition and pair of
+    definitions, instead of once per point, and whole coordinate arrays reprojected in one
+    TransformPoints call. Axis order is x/longitude first throughout. Transformations are
+    not thread safe, so every thread keeps its own.
+    """
+    def __init__(self) -> None:
+        self.local = threading.local()
+        self.wkts = {}
+
+    def __cache__(self):
+        if not hasattr(self.local, "srs"):
+            self.local.srs = {}
+            self.local.transformers = {}
+        return self.local
+
+    def srs(self, definition:str) -> osr.SpatialReference:
+        cache = self.__cache__().srs
+        if definition not in cache:
+            srs = osr.SpatialReference()
+            srs.SetFromUserInput(definition)
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            cache[definition] = srs
+        return cache[definition]
+
+    def wkt(self, definition:str) -> str:
+        if definition not in self.wkts:
+            self.wkts[definition] = self.srs(definition).ExportToWkt()
+        return self.wkts[definition]
+
+    def transformer(self, src:str, dst:str) -> osr.CoordinateTransformation:
+        cache = self.__cache__().transformers
+        if (src, dst) not in cache:
+            cache[(src, dst)] = osr.CoordinateTransformation(self.srs(src), self.srs(dst))
+        return cache[(src, dst)]
+
+    def transform(self, xs, ys, src:str, dst:str):
+        """xs, ys arrays of any shape from src to dst, in one call"""
+        xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+        if not xs.size:
+            return xs.copy(), ys.copy()
+        points = self.transformer(src, dst).TransformPoints(np.column_stack([xs.ravel(), ys.ravel()]).tolist())
+        points = np.array(points, dtype=np.float64).reshape(-1, 3)
+        return points[:, 0].reshape(xs.shape), points[:, 1].reshape(ys.shape)
+
+
+def file_hash(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Shared by every module of a process
+projections = ProjectionService()
@@ -0,0 +1,294 @@
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from cog import CogWriter
+from projection import projections
+
+
+class RemapTable:
+    """
+    Source pixel indices and resampling weights for every valid pixel of a box in the
+    target grid. apply() is a single NumPy gather over the flattened source raster.
+    """
+    def __init__(self, shape, geo_transform, valid, index, weights) -> None:
+        self.shape = tuple(int(v) for v in shape)
+        self.geo_transform = tuple(float(v) for v in geo_transform)
+        self.valid = valid
+        self.index = index
+        self.weights = weights
+
+    def apply(self, data, nodata=None):
+        fill = 0 if nodata is None else nodata
+        out = np.full(self.shape[0] * self.shape[1], fill, dtype=data.dtype)
+        values = data.ravel()[self.index]
+        if self.index.shape[1] == 1:
+            out[self.valid] = values[:, 0]
+            return out.reshape(self.shape)
+
+        weights = self.weights
+        if nodata is not None:
+            weights = np.where(values == nodata, 0, weights)
+        total = weights.sum(axis=1)
+        filled = total > 0
+        blended = (values * weights).sum(axis=1)[filled] / total[filled]
+        if data.dtype.kind in "iu":
+            blended = np.rint(blended)
+        out[self.valid[filled]] = blended.astype(data.dtype)
+        return out.reshape(self.shape)
+
+    def save(self, path):
+        # Written aside and renamed, worker processes may compute the same table at once
+        part = f"{path}.{os.getpid()}.part.npz"
+        np.savez(part, shape=self.shape, geo_transform=self.geo_transform,
+                 valid=self.valid, index=self.index, weights=self.weights)
+        os.replace(part, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["shape"], f["geo_transform"], f["valid"], f["index"], f["weights"])
+
+
+class Reprojector:
+    """
+    Crops rasters in the fixed ABI grid (ESRI:102498) to a box and reprojects them with
+    precomputed RemapTables instead of a gdal.Warp per granule and box. A table depends only
+    on the box, the source grid and the target grid, so it is computed once and cached in
+    `cache_dir`. resolution is in target units, by default the source pixel size at the box.
+    """
+    def __init__(self, cache_dir, resolution:float=None, resampling:str="nearest", writer:CogWriter=None) -> None:
+        if resampling not in ("nearest", "bilinear"):
+            raise ValueError(f"Unsupported resampling {resampling}")
+        self.cache_dir = cache_dir
+        self.resolution = resolution
+        self.resampling = resampling
+        self.writer = writer or CogWriter()
+        self.tables = {}
+        self.cutlines = {}
+        self.windows = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def srs(definition):
+        return projections.srs(definition)
+
+    @staticmethod
+    def read(path):
+        """Reads a single band raster as (data, geo_transform, nodata, scale, offset)"""
+        ds = gdal.Open(path)
+        band = ds.GetRasterBand(1)
+        source = (band.ReadAsArray(), ds.GetGeoTransform(), band.GetNoDataValue(), band.GetScale(), band.GetOffset())
+        ds = None
+        return source
+
+    @staticmethod
+    def extent(source, padding:int=1):
+        """(minx, miny, maxx, maxy) of a source raster in its own grid, padded by whole pixels"""
+        data, geo_transform = source[:2]
+        xs = geo_transform[0] + np.array([-padding, data.shape[1] + padding]) * geo_transform[1]
+        ys = geo_transform[3] + np.array([-padding, data.shape[0] + padding]) * geo_transform[5]
+        return xs.min(), ys.min(), xs.max(), ys.max()
+
+    def crop_many(self, source, boxes, dst_srs:str="EPSG:3857", index=None, tiles=None):
+        """
+        Yields (box, array, geo_transform) for every box, all gathered from the one decoded
+        source array. With a bbox.BboxIndex, boxes outside the data extent are skipped.
+        tiles, {box id: bbox.Tile}, gathers overlapping boxes once as their shared tile and
+        slices every box out of it.
+        """
+        if index is not None:
+            covered = set(id(box) for box in index.query(*self.extent(source)))
+            boxes = [box for box in boxes if id(box) in covered]
+        shared = {}
+        for box in boxes:
+            tile = (tiles or {}).get(box.id)
+            if tile is None:
+                yield (box,) + self.crop(source, box, dst_srs)
+            else:
+                shared.setdefault(tile.id, (tile, []))[1].append(box)
+
+        for tile, members in shared.values():
+            if len(members) == 1:
+                yield (members[0],) + self.crop(source, members[0], dst_srs)
+                continue
+            out, out_transform = self.crop(source, tile, dst_srs)
+            for box in members:
+                yield (box,) + self.slice(out, out_transform, box, dst_srs, source[2])
+
+    def slice(self, out, out_transform, box, dst_srs:str="EPSG:3857", nodata=None):
+        """Returns (array, geo_transform) of box cut from the tile array out, outside the box set to nodata"""
+        key = (self.__cutline_hash__(box), tuple(out_transform), out.shape, dst_srs)
+        if key not in self.windows:
+            geometry = self.__cutline__(box, dst_srs)
+            minx, maxx, miny, maxy = geometry.GetEnvelope()
+            col0 = int(np.clip(np.floor((minx - out_transform[0]) / out_transform[1]), 0, out.shape[1] - 1))
+            col1 = int(np.clip(np.ceil((maxx - out_transform[0]) / out_transform[1]), col0 + 1, out.shape[1]))
+            row0 = int(np.clip(np.floor((maxy - out_transform[3]) / out_transform[5]), 0, out.shape[0] - 1))
+            row1 = int(np.clip(np.ceil((miny - out_transform[3]) / out_transform[5]), row0 + 1, out.shape[0]))
+            geo_transform = (out_transform[0] + col0 * out_transform[1], out_transform[1], 0.0,
+                             out_transform[3] + row0 * out_transform[5], 0.0, out_transform[5])
+            outside = self.__mask__(geometry, geo_transform, row1 - row0, col1 - col0, self.srs(dst_srs)) == 0
+            self.windows[key] = (row0, row1, col0, col1, geo_transform, outside)
+        row0, row1, col0, col1, geo_transform, outside = self.windows[key]
+        window = out[row0:row1, col0:col1].copy()
+        window[outside] = 0 if nodata is None else nodata
+        return window, geo_transform
+
+    def warp_many(self, source, boxes, out_path, dst_srs:str="EPSG:3857", index=None, layer=None, tiles=None):
+        """
+        Writes every box cropped from source to out_path(box). Returns (path, output) for every
+        path written, output holding the array and its geo metadata as written, before any
+        quantization.
+        """
+        nodata, scale, offset = source[2:]
+        written = []
+        for box, out, out_transform in self.crop_many(source, boxes, dst_srs, index, tiles):
+            output = dict(data=out, geo_transform=out_transform, projection=projections.wkt(dst_srs),
+                          nodata=0 if nodata is None else nodata, scale=scale, offset=offset)
+            written.append((self.write(out_path(box), out, out_transform, source, dst_srs, layer), output))
+        return written
+
+    def crop(self, source, box, dst_srs:str="EPSG:3857"):
+        """Returns (array, geo_transform) of source cropped to box in dst_srs"""
+        data, geo_transform, nodata = source[:3]
+        table = self.table(box, geo_transform, data.shape, dst_srs)
+        return table.apply(data, nodata), table.geo_transform
+
+    def warp(self, source, box, out_path, dst_srs:str="EPSG:3857", layer=None):
+        out, out_transform = self.crop(source, box, dst_srs)
+        return self.write(out_path, out, out_transform, source, dst_srs, layer)
+
+    def write(self, out_path, out, out_transform, source, dst_srs:str="EPSG:3857", layer=None):
+        nodata, scale, offset = source[2:]
+        return self.writer.write(out_path, out, out_transform, projections.wkt(dst_srs),
+                                 0 if nodata is None else nodata, scale, offset, layer)
+
+    def __cutline_hash__(self, box):
+        if getattr(box, "geometry", None) is not None:
+            # Boxes of a collection share its path, their own geometry identifies them
+            key = (box.path, box.id)
+            if key not in self.cutlines:
+                self.cutlines[key] = hashlib.sha256(json.dumps(box.geometry, sort_keys=True).encode()).hexdigest()
+            return self.cutlines[key]
+        if box.path not in self.cutlines:
+            with open(box.path, "rb") as f:
+                self.cutlines[box.path] = hashlib.sha256(f.read()).hexdigest()
+        return self.cutlines[box.path]
+
+    def table(self, box, geo_transform, shape, dst_srs:str="EPSG:3857"):
+        key = hashlib.sha256(repr((self.__cutline_hash__(box), tuple(geo_transform), tuple(shape), dst_srs,
+                                   self.resolution, self.resampling)).encode()).hexdigest()
+        if key in self.tables:
+            self.hits += 1
+            return self.tables[key]
+
+        path = os.path.join(self.cache_dir, f"{box.id}_{key[:16]}.npz")
+        if os.path.exists(path):
+            self.hits += 1
+            table = RemapTable.load(path)
+        else:
+            self.misses += 1
+            logging.info(f"Computing remap table for {box.id} into {dst_srs}")
+            table = self.__compute__(box, geo_transform, shape, dst_srs)
+            table.save(path)
+        self.tables[key] = table
+        return table
+
+    def __cutline__(self, box, dst_srs:str):
+        """Union of the box's features, in dst_srs"""
+        if getattr(box, "geometry", None) is not None:
+            geometry = ogr.CreateGeometryFromJson(json.dumps(box.geometry))
+            geometry.Transform(projections.transformer("EPSG:4326", dst_srs))
+            return geometry
+        ds = ogr.Open(box.path)
+        layer = ds.GetLayer()
+        layer_srs = layer.GetSpatialRef()
+        if layer_srs is None:
+            transform = projections.transformer("EPSG:4326", dst_srs)
+        else:
+            layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            transform = osr.CoordinateTransformation(layer_srs, self.srs(dst_srs))
+        geometry = ogr.Geometry(ogr.wkbMultiPolygon)
+        for feature in layer:
+            geom = feature.GetGeometryRef().Clone()
+            geom.Transform(transform)
+            geometry = geometry.Union(geom)
+        return geometry
+
+    def __resolution__(self, geometry, geo_transform, dst_srs:str):
+        if self.resolution is not None:
+            return self.resolution
+        # Size of the source pixel under the box centre, measured in the target grid
+        centre = geometry.Centroid()
+        to_source = projections.transformer(dst_srs, "ESRI:102498")
+        to_target = projections.transformer("ESRI:102498", dst_srs)
+        x, y, _ = to_source.TransformPoint(centre.GetX(), centre.GetY())
+        corners = to_target.TransformPoints([(x, y), (x + geo_transform[1], y), (x, y + geo_transform[5])])
+        width = np.hypot(corners[1][0] - corners[0][0], corners[1][1] - corners[0][1])
+        height = np.hypot(corners[2][0] - corners[0][0], corners[2][1] - corners[0][1])
+        return float(np.sqrt(width * height))
+
+    @staticmethod
+    def __mask__(geometry, geo_transform, rows, cols, dst_srs):
+        """1 where the (rows, cols) grid's pixels are covered by geometry"""
+        mask_ds = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Byte)
+        mask_ds.SetGeoTransform(geo_transform)
+        mask_ds.SetProjection(dst_srs.ExportToWkt())
+        vector = ogr.GetDriverByName("Memory").CreateDataSource("")
+        layer = vector.CreateLayer("cutline", dst_srs)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+        gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1])
+        return mask_ds.GetRasterBand(1).ReadAsArray()
+
+    def __compute__(self, box, geo_transform, shape, dst_srs:str):
+        geometry = self.__cutline__(box, dst_srs)
+        resolution = self.__resolution__(geometry, geo_transform, dst_srs)
+        minx, maxx, miny, maxy = geometry.GetEnvelope()
+        cols = max(int(round((maxx - minx) / resolution)), 1)
+        rows = max(int(round((maxy - miny) / resolution)), 1)
+        out_transform = (minx, (maxx - minx) / cols, 0.0, maxy, 0.0, -(maxy - miny) / rows)
+
+        # Target pixels covered by the cutline, as cropToCutline masks them
+        inside = np.flatnonzero(self.__mask__(geometry, out_transform, rows, cols, self.srs(dst_srs)))
+
+        # Target pixel centres, back into source pixel coordinates
+        row, col = np.divmod(inside, cols)
+        xs = out_transform[0] + (col + 0.5) * out_transform[1]
+        ys = out_transform[3] + (row + 0.5) * out_transform[5]
+        source_xs, source_ys = projections.transform(xs, ys, dst_srs, "ESRI:102498")
+        px = (source_xs - geo_transform[0]) / geo_transform[1]
+        py = (source_ys - geo_transform[3]) / geo_transform[5]
+
+        height, width = shape
+        if self.resampling == "nearest":
+            ix, iy = np.floor(px), np.floor(py)
+            keep = np.isfinite(px) & np.isfinite(py) & (ix >= 0) & (ix < width) & (iy >= 0) & (iy < height)
+            index = (iy[keep] * width + ix[keep]).astype(np.int64)[:, None]
+            weights = np.ones(index.shape, dtype=np.float32)
+        else:
+            fx, fy = px - 0.5, py - 0.5
+            x0, y0 = np.floor(fx), np.floor(fy)
+            keep = np.isfinite(fx) & np.isfinite(fy) & (x0 >= -1) & (x0 < width) & (y0 >= -1) & (y0 < height)
+            fx, fy, x0, y0 = fx[keep] - x0[keep], fy[keep] - y0[keep], x0[keep], y0[keep]
+            index, weights = [], []
+            for dy, dx, w in ((0, 0, (1 - fx) * (1 - fy)), (0, 1, fx * (1 - fy)),
+                              (1, 0, (1 - fx) * fy), (1, 1, fx * fy)):
+                x, y = x0 + dx, y0 + dy
+                inside_grid = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+                index.append((np.clip(y, 0, height - 1) * width + np.clip(x, 0, width - 1)).astype(np.int64))
+                weights.append(np.where(inside_grid, w, 0).astype(np.float32))
+            index, weights = np.column_stack(index), np.column_stack(weights)
+
+        return RemapTable((rows, cols), out_transform, inside[keep].astype(np.int64), index, weights)
+
+    def log_stats(self):
+        logging.info(f"Remap tables: {self.hits} hits, {self.misses} computed")
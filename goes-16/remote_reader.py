@@ -0,0 +1,36 @@
+import logging
+
+import h5netcdf
+
+from extraction import GranuleExtractor
+
+
+class RemoteGranuleReader:
+    """
+    Reads variables of a GOES NetCDF granule straight from S3, fetching only the
+    blocks that cover a pixel window, and writes them as GeoTIFFs in the ABI fixed
+    grid (ESRI:102498), the same as gdal.Translate of NETCDF:<file>:<band>.
+    """
+    def __init__(self, fs, block_size:int=2**20, padding:int=2) -> None:
+        self.fs = fs
+        self.block_size = block_size
+        self.extractor = GranuleExtractor(padding)
+
+    @staticmethod
+    def bounds(boxes):
+        """Union (minx, miny, maxx, maxy) of boxes already projected to ESRI:102498"""
+        xs = [point.x for box in boxes for point in box.box]
+        ys = [point.y for box in boxes for point in box.box]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def read_window(self, key, variable, bounds, out_path):
+        written = self.read_layers(key, [(variable, variable)], {variable: out_path}, bounds)
+        return None if written is None else out_path
+
+    def read_layers(self, key, layers, out_paths, bounds):
+        with self.fs.open(key, mode="rb", block_size=self.block_size, cache_type="blockcache") as f:
+            with h5netcdf.File(f, "r") as nc:
+                written = self.extractor.extract(nc, layers, out_paths, bounds)
+        if written is None:
+            logging.warning(f"{key} does not cover the requested bboxes")
+        return written
@@ -0,0 +1,37 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """
+    Small thread-safe wrapper around a local SQLite database. Subclasses
+    define their tables in `schema`.
+    """
+    schema = ""
+
+    def __init__(self, db_path) -> None:
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.schema)
+        self.connection.commit()
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+            self.connection.commit()
+        return rows
+
+    def executemany(self, sql, seq_params):
+        with self.lock:
+            self.connection.executemany(sql, seq_params)
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
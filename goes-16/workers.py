@@ -0,0 +1,196 @@
+import os
+import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from osgeo import gdal
+
+from bbox import BboxIndex
+from extraction import GranuleExtractor
+from remap import Reprojector
+from cog import CogWriter
+
+
+# FDCC variables recorded with every fire pixel, extracted next to the confidence layer
+FIRE_VARIABLES = (("_power", "Power"), ("_temp", "Temp"), ("_area", "Area"))
+
+
+class GranuleProcessor:
+    """
+    Raster work on one downloaded granule: layer extraction, cloud scoring and box warps.
+    It holds no S3 or SQLite state, so every worker process builds its own copy.
+    """
+    def __init__(self, root_dir, remap_dir, boxes, compress:str="DEFLATE", quantize=(), tiles=None) -> None:
+        self.root_dir = root_dir
+        self.boxes = boxes
+        self.box_index = BboxIndex(boxes)
+        self.tiles = tiles or {} # {box id: bbox.Tile} of boxes processed through a shared tile
+        self.extractor = GranuleExtractor()
+        self.reprojector = Reprojector(remap_dir, writer=CogWriter(compress, quantize=quantize))
+
+    @staticmethod
+    def layer_files(directory, layers):
+        """Downloaded NetCDF granules in directory, then granules remote reads left as layer GeoTIFFs"""
+        files = sorted(file for file in os.listdir(directory) if file.endswith('.nc'))
+        remote_files = set()
+        for save_location, _ in layers:
+            layer_dir = os.path.join(directory, save_location)
+            if os.path.isdir(layer_dir):
+                remote_files.update(os.listdir(layer_dir))
+        return files + sorted(remote_files)
+
+    def open_layers(self, directory, file, layers):
+        """{save_location: path} of one granule, extracting NetCDF granules into /vsimem/"""
+        if file.endswith('.nc'):
+            out_paths = {save_location: f"/vsimem{os.path.abspath(directory)}/{save_location}/{file.replace('.nc', '.tif')}"
+                         for save_location, _ in layers}
+            return self.extractor.extract_file(os.path.join(directory, file), layers, out_paths)
+        paths = {save_location: os.path.join(directory, save_location, file) for save_location, _ in layers}
+        return {save_location: path for save_location, path in paths.items() if os.path.exists(path)}
+
+    @staticmethod
+    def close_layers(directory, file, paths):
+        if file.endswith('.nc'):
+            for path in paths.values():
+                gdal.Unlink(path)
+            os.remove(os.path.join(directory, file))
+
+    def clear_fractions(self, source, boxes=None):
+        """
+        Share of each box's DQF pixels equal to 0, all cropped from the one decoded source
+        (a Reprojector.read result). Boxes outside the data extent are left out.
+        """
+        fractions = {}
+        for box, imarray, _ in self.reprojector.crop_many(source, boxes or self.boxes, "ESRI:102498", self.box_index,
+                                                               self.tiles):
+            fractions[box] = np.count_nonzero(imarray == 0) / imarray.size
+        return fractions
+
+    def warp_boxes(self, path, boxes, save_location, file_path):
+        """
+        Decodes path once and writes it cropped to every box as <box>/<save_location>/<file_path>,
+        returning (path, output) pairs (see Reprojector.warp_many)
+        """
+        source = self.reprojector.read(path)
+        return self.reprojector.warp_many(source, boxes,
+                                          lambda box: f"{self.root_dir}/{box.id}/{save_location}/{file_path}",
+                                          index=self.box_index, layer=save_location, tiles=self.tiles)
+
+    def cloud_task(self, directory, file, box_ids=None):
+        """Returns {box id: clear fraction} of one granule's DQF, for the boxes in box_ids or all"""
+        layers = [("dqf", "DQF")]
+        boxes = None if box_ids is None else [box for box in self.boxes if box.id in box_ids]
+        paths = self.open_layers(directory, file, layers)
+        try:
+            return {box.id: fraction for box, fraction in self.clear_fractions(self.reprojector.read(paths["dqf"]), boxes).items()}
+        finally:
+            self.close_layers(directory, file, paths)
+
+    def fire_pixels(self, paths, boxes, confidence_location):
+        """
+        {box id: columns} of the pixels with a positive confidence in every box: EPSG:3857
+        pixel centres, confidence and the FDCC Power/Temp/Area values they hold.
+        """
+        records = {}
+        confidence = self.reprojector.read(paths[confidence_location])
+        for box, data, geo_transform in self.reprojector.crop_many(confidence, boxes, index=self.box_index, tiles=self.tiles):
+            rows, cols = np.nonzero(data > 0)
+            if rows.size:
+                records[box.id] = {"x": geo_transform[0] + (cols + 0.5) * geo_transform[1],
+                                   "y": geo_transform[3] + (rows + 0.5) * geo_transform[5],
+                                   "confidence": data[rows, cols]}
+        if not records:
+            return records
+
+        # Cropped over the same boxes as the confidence, so boxes sharing a tile are cut alike
+        for save_location, _ in FIRE_VARIABLES:
+            name = save_location[1:]
+            if save_location not in paths:
+                for columns in records.values():
+                    columns[name] = np.full(len(columns["x"]), np.nan)
+                continue
+            source = self.reprojector.read(paths[save_location])
+            nodata, scale, offset = source[2:]
+            for box, data, geo_transform in self.reprojector.crop_many(source, boxes, index=self.box_index, tiles=self.tiles):
+                if box.id not in records:
+                    continue
+                columns = records[box.id]
+                rows = np.rint((columns["y"] - geo_transform[3]) / geo_transform[5] - 0.5).astype(np.int64)
+                cols = np.rint((columns["x"] - geo_transform[0]) / geo_transform[1] - 0.5).astype(np.int64)
+                values = data[rows, cols].astype(np.float64)
+                if nodata is not None:
+                    values[values == nodata] = np.nan
+                columns[name] = values * (scale or 1.0) + (offset or 0.0)
+        return records
+
+    def warp_task(self, directory, file, layers, box_ids, file_path, fire_records:bool=False, outputs:bool=False):
+        """
+        Warps every layer of one granule to the boxes in box_ids. Returns the (path, output)
+        pairs written, output None unless `outputs` is set so arrays only come back from a
+        worker when a sink needs them, and, with fire_records, the fire pixels of every box
+        (see fire_pixels).
+        """
+        boxes = [box for box in self.boxes if box.id in box_ids]
+        confidence = [save_location for save_location, band in layers if band == "wildfire"]
+        fire_records = fire_records and bool(confidence) and file.endswith('.nc')
+        paths = self.open_layers(directory, file, list(layers) + (list(FIRE_VARIABLES) if fire_records else []))
+        try:
+            written = []
+            for save_location, path in paths.items():
+                if save_location.startswith("_"):
+                    continue # Only recorded with fire pixels
+                written += [(out_path, output if outputs else None)
+                            for out_path, output in self.warp_boxes(path, boxes, save_location, file_path)]
+            records = self.fire_pixels(paths, boxes, confidence[0]) if fire_records else {}
+            return written, records
+        finally:
+            self.close_layers(directory, file, paths)
+
+
+_processor = None
+
+def _init_worker(log_queue, *processor_args):
+    global _processor
+    # Records go back to the parent, which owns the log file
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    _processor = GranuleProcessor(*processor_args)
+
+def _run(method, *args):
+    return getattr(_processor, method)(*args)
+
+
+class RasterPool:
+    """
+    Runs GranuleProcessor tasks on `workers` processes. Worker log records are forwarded
+    to the parent's handlers and a failed task is logged and kept in `errors` instead of
+    stopping the others.
+    """
+    def __init__(self, workers:int, *processor_args) -> None:
+        context = multiprocessing.get_context("spawn") # The parent runs S3 and pipeline threads
+        self.log_queue = context.Queue()
+        self.listener = QueueListener(self.log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        self.listener.start()
+        self.executor = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                            initargs=(self.log_queue,) + processor_args)
+        self.errors = []
+
+    def map(self, method, tasks):
+        """Yields (task, result) as tasks finish"""
+        futures = {self.executor.submit(_run, method, *task): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"{method}{task} failed: {e}", exc_info=e)
+                self.errors.append((method, task, e))
+                continue
+            yield task, result
+
+    def close(self):
+        self.executor.shutdown()
+        self.listener.stop()